@@ -0,0 +1,98 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import tracing
+
+
+def normalize_question(question):
+    """Lower case the question, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
+class AnswerCache:
+    """Cache of generated answers for repeated and near duplicate questions
+
+    A lookup first tries an exact match on the normalized question, then
+    falls back to the most similar cached question embedding if its cosine
+    similarity is at least `threshold`. Entries expire after `ttl` seconds
+    and the least recently used entries are evicted past `max_entries`.
+    Answers generated from a RAG context are only returned while the vector
+    store is at the generation (returned by `generation`, e.g. a
+    GenerationCounter) they were generated at, so documents added or removed
+    by any process invalidate them.
+    """
+
+    def __init__(self, embedding, generation=None, threshold=0.98, ttl=3600, max_entries=1000):
+        self.embedding = embedding
+        self.generation = generation or (lambda: None)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _embed(self, question):
+        vector = np.asarray(self.embedding.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _expire(self, generation):
+        now = time.time()
+        for key in [
+            key
+            for key, entry in self._entries.items()
+            if now - entry["created"] > self.ttl or (entry["context"] is not None and entry["generation"] != generation)
+        ]:
+            del self._entries[key]
+
+    def get(self, mode, question):
+        """Return the cached entry for the question in the given mode, or None"""
+        key = (mode, normalize_question(question))
+        generation = self.generation()
+        with self._lock:
+            self._expire(generation)
+            entry = self._entries.get(key)
+            candidates = [(k, e) for k, e in self._entries.items() if k[0] == mode]
+
+        if entry is None and candidates:
+            vector = self._embed(question)
+            scores = np.stack([e["vector"] for _, e in candidates]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key, entry = candidates[best]
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                tracing.count("answer_cache_misses")
+                return None
+            self.hits += 1
+            tracing.count("answer_cache_hits")
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, mode, question, answer, context=None, generation=None):
+        """Cache the answer, and the RAG context it was generated from at `generation`, for the question
+
+        Pass the generation read before retrieving, an answer whose context
+        may predate documents added since is never returned.
+        """
+        entry = {
+            "answer": answer,
+            "context": context,
+            "generation": generation,
+            "vector": self._embed(question),
+            "created": time.time(),
+        }
+        with self._lock:
+            key = (mode, normalize_question(question))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
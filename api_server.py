@@ -0,0 +1,349 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import tracing
+from documents import list_documents
+from rag_factories import get_components, ingest_upload, make_retriever, remove_upload
+from rag_pipeline import stream_answer, stream_concurrently, stream_rag_answer
+from tenants import SHARED_TENANT, answer_mode, resolve_tenant, visible_tenants
+
+MODES = ("pure", "rag")
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+
+_DONE = object()
+
+# Answers are generated on their own threads, at most API_MAX_STREAMS at once, later ones wait for a free thread
+_stream_pool = ThreadPoolExecutor(max_workers=int(os.getenv("API_MAX_STREAMS", "32")), thread_name_prefix="answer_stream")
+
+
+def answer_events(components, question, modes, tenant):
+    """Answer the question in each mode, yielding the (event, data) pairs of the SSE response
+
+    Tokens of the modes are interleaved as they are generated, cached
+    answers are sent as a single token, the RAG context follows the
+    answers and the stage timings come last. RAG only retrieves the PDFs
+    the tenant may see.
+    """
+    answer_cache = components["answer_cache"]
+    retriever = make_retriever(
+        components["vector_store"], components["embedding"], components["search_client"], visible_tenants(tenant)
+    )
+    with tracing.trace("question", api=True, pure_llm="pure" in modes, rag="rag" in modes) as question_trace:
+        timings = {}
+        rag_context = {}
+        streams = {}
+        responses = {}
+        # Read before retrieving, so an answer racing an upload is not cached as current
+        generation = answer_cache.generation()
+
+        for mode in modes:
+            cached = answer_cache.get(answer_mode(mode, tenant), question)
+            if cached:
+                responses[mode] = cached["answer"]
+                timings[mode + "_cache_hit"] = 0.0
+                if mode == "rag":
+                    rag_context.update(cached["context"])
+                yield "token", {"mode": mode, "text": cached["answer"]}
+            elif mode == "pure":
+                responses[mode] = ""
+                streams[mode] = lambda: stream_answer(components["chain_without_rag"], question, timings, prefix="pure_")
+            else:
+                responses[mode] = ""
+                streams[mode] = lambda: stream_rag_answer(
+                    retriever, components["chain"], question, timings, rag_context, components["assemble"]
+                )
+
+        for mode, chunk in stream_concurrently(streams):
+            responses[mode] += chunk
+            yield "token", {"mode": mode, "text": chunk}
+
+        for mode in streams:
+            answer_cache.put(
+                answer_mode(mode, tenant), question, responses[mode], dict(rag_context) if mode == "rag" else None, generation
+            )
+        for name, value in timings.items():
+            if isinstance(value, int):
+                question_trace.count(name, value)
+
+        if "rag" in modes:
+            yield "context", rag_context
+        yield "done", {
+            "trace_id": question_trace.id,
+            "timings": {name: value if isinstance(value, int) else value * 1000 for name, value in timings.items()},
+        }
+
+
+def sse_event(event, data):
+    """Encode one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def insecure():
+    """Return True when API_INSECURE=1 explicitly allows requests without a token"""
+    return os.getenv("API_INSECURE") == "1"
+
+
+def api_tokens():
+    """Return the tenant of each bearer token, API_TOKEN's is the shared one and API_TOKENS maps `token:tenant,...`"""
+    tokens = {}
+    if os.getenv("API_TOKEN"):
+        tokens[os.getenv("API_TOKEN")] = SHARED_TENANT
+    for pair in os.getenv("API_TOKENS", "").split(","):
+        token, _, tenant = pair.strip().partition(":")
+        if token and tenant.strip():
+            tokens[token] = tenant.strip()
+    return tokens
+
+
+def check_auth_configured():
+    """Refuse to serve without API_TOKEN or API_TOKENS, unless API_INSECURE=1"""
+    if not api_tokens() and not insecure():
+        raise RuntimeError(
+            "Neither API_TOKEN nor API_TOKENS is set, set one or set API_INSECURE=1 to serve without authentication"
+        )
+
+
+def header_tenant(scope):
+    """Return the tenant named by the X-Tenant header, or an empty string"""
+    return dict(scope["headers"]).get(b"x-tenant", b"").decode("utf-8").strip()
+
+
+def token_tenant(scope):
+    """Return the tenant of the request's bearer token, or None if it has none or a wrong one
+
+    With API_INSECURE=1 and no tokens configured, every request is allowed
+    and the X-Tenant header names its tenant.
+    """
+    tokens = api_tokens()
+    if not tokens:
+        return (header_tenant(scope) or SHARED_TENANT) if insecure() else None
+    authorization = dict(scope["headers"]).get(b"authorization", b"")
+    tenant = None
+    # Compare with every token, so the time taken doesn't tell which one matched
+    for token, owner in tokens.items():
+        if hmac.compare_digest(authorization, f"Bearer {token}".encode("utf-8")):
+            tenant = owner
+    return tenant
+
+
+def request_tenant(scope):
+    """Return the tenant of the request's credential, whose PDFs it uploads, lists, deletes and asks about"""
+    return resolve_tenant(token_tenant(scope))
+
+
+async def read_body(receive, limit):
+    """Return the request body, or None if it is larger than `limit` bytes"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+async def send_json(send, status, body):
+    data = json.dumps(body).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": data})
+
+
+async def run_blocking(context, fn, *args):
+    """Run a blocking call on the default executor inside `context`, so it records into its trace"""
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, fn, *args)
+
+
+def produce(events, loop, items, stop):
+    """Run the blocking event generator to its end, handing each event to the event loop
+
+    Runs on a stream thread, so a slow client never holds it: the events
+    are queued for the client however fast it reads them. Stops at the next
+    event once `stop` is set, closing the generator and its LLM streams.
+    """
+    try:
+        for item in events:
+            if stop.is_set():
+                break
+            loop.call_soon_threadsafe(items.put_nowait, item)
+    except Exception as e:
+        loop.call_soon_threadsafe(items.put_nowait, ("error", {"error": str(e)}))
+    finally:
+        events.close()
+        loop.call_soon_threadsafe(items.put_nowait, _DONE)
+
+
+async def ask(scope, receive, send):
+    """POST /ask {"question": ..., "modes": ["pure", "rag"]}, streams the answers as SSE"""
+    body = await read_body(receive, 64 * 1024)
+    try:
+        request = json.loads(body or b"")
+        question = request["question"].strip()
+        modes = request.get("modes", list(MODES))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        await send_json(send, 400, {"error": 'Expected a JSON body with a "question"'})
+        return
+    if not question or not modes or any(mode not in MODES for mode in modes):
+        await send_json(send, 400, {"error": f"The question must not be empty and the modes must be in {list(MODES)}"})
+        return
+
+    # Only a working setup gets the 200, once it is sent errors can only be events
+    try:
+        components = await run_blocking(contextvars.copy_context(), get_components)
+    except Exception as e:
+        await send_json(send, 500, {"error": str(e)})
+        return
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        }
+    )
+    # The generator blocks on the retriever and the LLM, so it runs on a
+    # stream thread, in a copy of this context so the trace sees every stage
+    events = answer_events(components, question, list(dict.fromkeys(modes)), request_tenant(scope))
+    items = asyncio.Queue()
+    stop = threading.Event()
+    _stream_pool.submit(contextvars.copy_context().run, produce, events, asyncio.get_running_loop(), items, stop)
+    try:
+        while (item := await items.get()) is not _DONE:
+            await send({"type": "http.response.body", "body": sse_event(*item), "more_body": True})
+    finally:
+        # The client is gone or the answer is done, either way the generation stops
+        stop.set()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def ingest(scope, receive, send):
+    """POST /ingest?filename=<name>.pdf with the PDF as the body, returns the ingest stats"""
+    file_name = parse_qs(scope["query_string"].decode("utf-8")).get("filename", ["upload.pdf"])[0]
+    data = await read_body(receive, MAX_UPLOAD_BYTES)
+    if data is None:
+        await send_json(send, 413, {"error": f"The PDF is larger than {MAX_UPLOAD_BYTES} bytes"})
+        return
+    if not data.startswith(b"%PDF"):
+        await send_json(send, 400, {"error": "The body is not a PDF"})
+        return
+
+    components = get_components()
+    try:
+        stats = await run_blocking(
+            contextvars.copy_context(),
+            ingest_upload,
+            file_name,
+            data,
+            components["vector_store"],
+            None,
+            request_tenant(scope),
+        )
+    except Exception as e:
+        await send_json(send, 500, {"error": str(e)})
+        return
+    await send_json(
+        send, 200, {key: stats[key] for key in ["pages", "chunks", "skipped", "removed", "seconds", "pages_per_s", "chunks_per_s"]}
+    )
+
+
+async def documents(scope, receive, send):
+    """GET /documents, returns the tenant's loaded PDFs that have not expired"""
+    components = get_components()
+    try:
+        loaded = await run_blocking(
+            contextvars.copy_context(), list_documents, components["vector_store"], [request_tenant(scope)]
+        )
+    except Exception as e:
+        await send_json(send, 500, {"error": str(e)})
+        return
+    await send_json(send, 200, {"documents": loaded})
+
+
+async def delete(scope, receive, send):
+    """DELETE /documents?source=<name>.pdf, deletes every chunk of the tenant's PDF"""
+    source = parse_qs(scope["query_string"].decode("utf-8")).get("source", [""])[0]
+    if not source:
+        await send_json(send, 400, {"error": 'Expected the "source" of the PDF to delete'})
+        return
+
+    components = get_components()
+    try:
+        deleted = await run_blocking(
+            contextvars.copy_context(),
+            remove_upload,
+            source,
+            components["vector_store"],
+            request_tenant(scope),
+        )
+    except Exception as e:
+        await send_json(send, 500, {"error": str(e)})
+        return
+    if not deleted:
+        await send_json(send, 404, {"error": f"No document '{source}'"})
+        return
+    await send_json(send, 200, {"source": source, "removed": deleted})
+
+
+async def metrics(scope, receive, send):
+    """GET /metrics, returns the latency summary of this worker's recent requests"""
+    await send_json(send, 200, tracing.summarize())
+
+
+ROUTES = {
+    ("GET", "/metrics"): metrics,
+    ("POST", "/ask"): ask,
+    ("POST", "/ingest"): ingest,
+    ("GET", "/documents"): documents,
+    ("DELETE", "/documents"): delete,
+}
+
+
+async def lifespan(receive, send):
+    """Build the clients and chains at startup, so the first request doesn't pay for it"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                check_auth_configured()
+                await asyncio.get_running_loop().run_in_executor(None, get_components)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application, run with e.g. `uvicorn api_server:app --workers 4`"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/healthz":
+        await send_json(send, 200, {"status": "ok"})
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await send_json(send, 404, {"error": "Not found"})
+    elif (tenant := token_tenant(scope)) is None:
+        await send_json(send, 401, {"error": "Missing or wrong bearer token"})
+    elif header_tenant(scope) not in ("", tenant):
+        await send_json(send, 403, {"error": "The bearer token is not the X-Tenant header's"})
+    else:
+        await handler(scope, receive, send)
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from datetime import timedelta
+from typing import Any, List, Optional
+
+from couchbase import search
+from couchbase.exceptions import (
+    AmbiguousTimeoutException,
+    ServiceUnavailableException,
+    TemporaryFailException,
+    UnAmbiguousTimeoutException,
+)
+from couchbase.options import SearchOptions
+from couchbase.vector_search import VectorQuery, VectorSearch
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import tracing
+from tenants import tenant_filter
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    AmbiguousTimeoutException,
+    UnAmbiguousTimeoutException,
+    ServiceUnavailableException,
+    TemporaryFailException,
+)
+
+
+class AsyncSearchClient:
+    """Couchbase search client running on its own asyncio event loop thread
+
+    Searches from every session share one acouchbase cluster connection and
+    one semaphore of `max_concurrency` in-flight requests. Each attempt is
+    limited to `timeout` seconds and retryable failures are retried
+    `retries` times with exponential backoff. Synchronous callers, such as
+    Streamlit script threads, use `search` and only wait for their own result.
+    """
+
+    def __init__(self, connect_string, authenticator, bucket_name, scope_name, index_name, max_concurrency=16, timeout=5.0, retries=2, backoff=0.1):
+        self.bucket_name = bucket_name
+        self.scope_name = scope_name
+        self.index_name = index_name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._scope = None
+        if connect_string is not None:
+            self.run(self._connect(connect_string, authenticator))
+
+    async def _connect(self, connect_string, authenticator):
+        from acouchbase.cluster import Cluster
+        from couchbase.options import ClusterOptions
+
+        cluster = await Cluster.connect(connect_string, ClusterOptions(authenticator))
+        await cluster.wait_until_ready(timedelta(seconds=5))
+        self._scope = cluster.bucket(self.bucket_name).scope(self.scope_name)
+
+    def run(self, coroutine):
+        """Run a coroutine on the client's loop and wait for its result from any thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _execute(self, search_req, k):
+        """Run one search request, returning (id, fields, score) rows"""
+        options = SearchOptions(limit=k, fields=["*"], timeout=timedelta(seconds=self.timeout))
+        result = self._scope.search(self.index_name, search_req, options)
+        return [(row.id, row.fields, row.score) async for row in result.rows()]
+
+    async def asearch(self, search_req, k):
+        """Run a search request within the concurrency bound, with a timeout and retries"""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    return await asyncio.wait_for(self._execute(search_req, k), self.timeout)
+            except RETRYABLE_ERRORS:
+                if attempt == self.retries:
+                    raise
+            # The backoff is waited out without a slot, so other searches go ahead meanwhile
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+    def search(self, search_req, k):
+        """Synchronous `asearch` for callers that are not on the client's loop"""
+        return self.run(self.asearch(search_req, k))
+
+
+class AsyncCouchbaseRetriever(BaseRetriever):
+    """Vector retriever that sends its searches through a shared AsyncSearchClient
+
+    The documents use the same layout as CouchbaseVectorStore writes. With
+    `tenants` the kNN query is prefiltered to their documents.
+    """
+
+    client: Any
+    embedding: Any
+    k: int = 4
+    text_key: str = "text"
+    embedding_key: str = "embedding"
+    tenants: Optional[List[str]] = None
+
+    def _request(self, query_embedding):
+        return search.SearchRequest.create(
+            VectorSearch.from_vector_query(
+                VectorQuery(self.embedding_key, query_embedding, self.k, prefilter=tenant_filter(self.tenants))
+            )
+        )
+
+    def _to_documents(self, rows):
+        docs = []
+        for id, fields, score in rows:
+            text = fields.pop(self.text_key, "")
+            # Search returns the metadata fields with a `metadata.` prefix
+            metadata = {key.split("metadata.", 1)[-1]: value for key, value in fields.items()}
+            docs.append(Document(id=id, page_content=text, metadata=metadata))
+        return docs
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        query_embedding = self.embedding.embed_query(query)
+        with tracing.span("vector_search"):
+            rows = self.client.search(self._request(query_embedding), self.k)
+        return self._to_documents(rows)
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        query_embedding = await self.embedding.aembed_query(query)
+        with tracing.span("vector_search"):
+            future = asyncio.run_coroutine_threadsafe(
+                self.client.asearch(self._request(query_embedding), self.k), self.client.loop
+            )
+            rows = await asyncio.wrap_future(future)
+        return self._to_documents(rows)
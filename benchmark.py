@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from chat_with_pdf import get_vector_store, save_to_vector_store
+from embedding_cache import CachedEmbeddings
+from fakes import FakeStreamingChatModel, HashingEmbeddings, WORDS, write_sample_pdf
+from rag_factories import build_rag_chain, make_assemble, make_retriever
+from rag_pipeline import retrieve, stream_rag_answer
+from tenants import SHARED_TENANT, visible_tenants
+
+
+def percentiles(seconds):
+    """Return p50/p95/p99 and the mean of the samples in milliseconds"""
+    values = np.asarray(seconds) * 1000
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+    }
+
+
+def sample_questions(pages, count, seed=0):
+    """Return (question, marker) pairs, the marker is the word only the relevant page contains"""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        page = rng.randrange(pages)
+        words = " ".join(rng.sample(WORDS, 3))
+        questions.append((f"What does the manual say about topic{page} and {words}?", f"topic{page}"))
+    return questions
+
+
+def run_size(pages, args):
+    """Ingest a sample corpus of `pages` pages into a fresh local store and time queries against it"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        pdf_path = os.path.join(work_dir, "sample.pdf")
+        write_sample_pdf(pdf_path, pages)
+        with open(pdf_path, "rb") as f:
+            upload = io.BytesIO(f.read())
+        upload.name = "sample.pdf"
+
+        os.environ["VECTOR_STORE"] = "local"
+        os.environ["LOCAL_VECTOR_STORE_PATH"] = os.path.join(work_dir, "store")
+        os.environ["RAG_TOP_K"] = str(args.k)
+        get_vector_store.clear()
+        embedding = CachedEmbeddings(
+            HashingEmbeddings(latency=args.embedding_latency), path=os.path.join(work_dir, "embedding_cache.sqlite")
+        )
+        vector_store = get_vector_store(None, None, None, None, embedding, None)
+        ingest = save_to_vector_store(upload, vector_store)
+
+        # The app's retriever, retrieval cache and context assembly, as a session sees the shared PDFs
+        retriever = make_retriever(vector_store, embedding, tenants=visible_tenants(SHARED_TENANT))
+        assemble = make_assemble(embedding)
+        questions = sample_questions(pages, args.queries)
+
+        retrieval = []
+        hits = 0
+        for question, marker in questions:
+            timings = {}
+            docs = retrieve(retriever, question, timings)
+            retrieval.append(timings["retrieval"])
+            hits += any(marker + " " in doc.page_content + " " for doc in docs)
+
+        chain = build_rag_chain(
+            FakeStreamingChatModel(
+                first_token_latency=args.first_token_latency, token_latency=args.token_latency
+            )
+        )
+        first_token = []
+        total = []
+        for question, _ in questions[: args.answers]:
+            start = time.perf_counter()
+            first = None
+            for chunk in stream_rag_answer(retriever, chain, question, {}, {}, assemble):
+                if first is None:
+                    first = time.perf_counter() - start
+            first_token.append(first)
+            total.append(time.perf_counter() - start)
+
+        return {
+            "pages": pages,
+            "chunks": ingest["chunks"],
+            "ingest": {
+                "seconds": ingest["seconds"],
+                "pages_per_s": ingest["pages_per_s"],
+                "chunks_per_s": ingest["chunks_per_s"],
+            },
+            "retrieval_ms": percentiles(retrieval),
+            "recall_at_k": hits / len(questions),
+            "time_to_first_token_ms": percentiles(first_token),
+            "total_answer_ms": percentiles(total),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, retrieval and answer latency with offline stand-ins")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000], help="corpus sizes in pages")
+    parser.add_argument("--queries", type=int, default=200, help="retrieval queries per corpus size")
+    parser.add_argument("--answers", type=int, default=20, help="streamed RAG answers per corpus size")
+    parser.add_argument("--k", type=int, default=8, help="documents retrieved per question, as RAG_TOP_K")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="seconds per fake embedding call")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="seconds to the fake LLM's first token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds between fake LLM tokens")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = {"config": vars(args), "results": [run_size(pages, args) for pages in args.pages]}
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmark import percentiles, sample_questions
+from fakes import HashingEmbeddings, sample_page_text
+from index_profiles import (
+    PROFILES,
+    delete_index,
+    index_settings,
+    indexed_count,
+    put_index_definition,
+    render_index_definition,
+)
+from local_vector_store import LocalVectorStore
+
+
+def sample_corpus(pages):
+    """Return the lines of the sample corpus, each one a document"""
+    return [line for page in range(pages) for line in sample_page_text(page)]
+
+
+def exact_top_k(doc_vectors, query_vectors, k):
+    """Return the rows of the true top-k documents of each query by dot product"""
+    scores = query_vectors @ doc_vectors.T
+    return [set(row.tolist()) for row in np.argpartition(-scores, k, axis=1)[:, :k]]
+
+
+def recall(found, truth):
+    """Return the mean fraction of the true top-k that was found"""
+    return float(np.mean([len(f & t) / len(t) for f, t in zip(found, truth)]))
+
+
+def run_local(settings, texts, doc_vectors, query_vectors, k, work_dir):
+    """Search the profile's vectors with the exact local store, optimized_for has no effect here"""
+    store = LocalVectorStore(None, path=os.path.join(work_dir, settings["profile"]), dims=settings["dims"])
+    store.add_embeddings(texts, doc_vectors, ids=[str(row) for row in range(len(texts))])
+
+    found = []
+    latencies = []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        rows = store.search_by_vectors([vector], k)[0]
+        latencies.append(time.perf_counter() - start)
+        found.append({row for row, _ in rows})
+    return found, latencies
+
+
+class CouchbaseBench:
+    """Loads the sample corpus into one collection per dims and creates one search index per profile"""
+
+    def __init__(self, args):
+        from couchbase.auth import PasswordAuthenticator
+        from couchbase.cluster import Cluster
+        from couchbase.options import ClusterOptions
+        from datetime import timedelta
+
+        self.args = args
+        self.username = os.environ["CB_USERNAME"]
+        self.password = os.environ["CB_PASSWORD"]
+        self.fts_hostname = os.getenv("CB_FTSHOSTNAME") or os.environ["CB_HOSTNAME"]
+        self.bucket_name = os.environ["CB_BUCKET"]
+        self.scope_name = os.environ["CB_SCOPE"]
+        auth = PasswordAuthenticator(self.username, self.password)
+        self.cluster = Cluster("couchbases://" + os.environ["CB_HOSTNAME"] + "/?ssl=no_verify", ClusterOptions(auth))
+        self.cluster.wait_until_ready(timedelta(seconds=5))
+        self.bucket = self.cluster.bucket(self.bucket_name)
+        self.scope = self.bucket.scope(self.scope_name)
+        self.collections = []
+        self.indexes = []
+        with open("search_indexdef.tmpl", "r") as template_file:
+            self.template = template_file.read()
+
+    def load(self, dims, texts, doc_vectors):
+        """Create the collection for `dims` and upsert the corpus into it, once"""
+        from couchbase.exceptions import CollectionAlreadyExistsException
+
+        collection_name = f"{self.args.collection}_{dims}"
+        if collection_name in self.collections:
+            return collection_name
+        try:
+            self.bucket.collections().create_collection(self.scope_name, collection_name)
+            time.sleep(1)
+        except CollectionAlreadyExistsException:
+            pass
+        self.collections.append(collection_name)
+
+        collection = self.scope.collection(collection_name)
+        docs = {
+            str(row): {"text": text, "embedding": vector.tolist(), "metadata": {}}
+            for row, (text, vector) in enumerate(zip(texts, doc_vectors))
+        }
+        ids = list(docs)
+        for start in range(0, len(ids), 500):
+            result = collection.upsert_multi({id: docs[id] for id in ids[start : start + 500]})
+            if not result.all_ok:
+                raise ValueError(f"Failed to load the sample corpus: {result.exceptions}")
+        return collection_name
+
+    def create_index(self, settings, collection_name, doc_count):
+        """Create the profile's index over the collection and wait until it has indexed every document"""
+        index_name = f"{self.args.collection}_{settings['profile']}"
+        definition = render_index_definition(
+            self.template, index_name, self.bucket_name, self.scope_name, collection_name, settings
+        )
+        response = put_index_definition(
+            self.username, self.password, self.fts_hostname, self.bucket_name, self.scope_name, index_name, json.dumps(definition)
+        )
+        if not response.ok:
+            raise ValueError(f"Failed to create index '{index_name}': {response.status_code} {response.text}")
+        self.indexes.append(index_name)
+
+        deadline = time.time() + self.args.index_timeout
+        while indexed_count(self.username, self.password, self.fts_hostname, self.bucket_name, self.scope_name, index_name) < doc_count:
+            if time.time() > deadline:
+                raise TimeoutError(f"Index '{index_name}' did not finish building in {self.args.index_timeout}s")
+            time.sleep(2)
+        return index_name
+
+    def search(self, index_name, vector, k):
+        from couchbase import search
+        from couchbase.options import SearchOptions
+        from couchbase.vector_search import VectorQuery, VectorSearch
+
+        search_req = search.SearchRequest.create(
+            VectorSearch.from_vector_query(VectorQuery("embedding", vector.tolist(), num_candidates=k))
+        )
+        return {int(row.id) for row in self.scope.search(index_name, search_req, SearchOptions(limit=k)).rows()}
+
+    def run(self, settings, texts, doc_vectors, query_vectors, k):
+        collection_name = self.load(settings["dims"], texts, doc_vectors)
+        index_name = self.create_index(settings, collection_name, len(texts))
+
+        # A few untimed queries so the first timed ones don't pay for loading the index
+        for vector in query_vectors[:5]:
+            self.search(index_name, vector, k)
+        found = []
+        latencies = []
+        for vector in query_vectors:
+            start = time.perf_counter()
+            found.append(self.search(index_name, vector, k))
+            latencies.append(time.perf_counter() - start)
+        return found, latencies
+
+    def cleanup(self):
+        """Drop the benchmark's indexes and collections"""
+        for index_name in self.indexes:
+            delete_index(self.username, self.password, self.fts_hostname, self.bucket_name, self.scope_name, index_name)
+        for collection_name in self.collections:
+            self.bucket.collections().drop_collection(self.scope_name, collection_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the recall vs. latency tradeoff of the search index profiles")
+    parser.add_argument("--backend", choices=["local", "couchbase"], default="local", help="exact local search or the CB_* cluster")
+    parser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES), help="profiles to compare")
+    parser.add_argument("--pages", type=int, default=100, help="sample corpus pages, 40 documents each")
+    parser.add_argument("--queries", type=int, default=200, help="sample queries per profile")
+    parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+    parser.add_argument("--full-dims", type=int, default=1536, help="dims of the untruncated embeddings")
+    parser.add_argument("--expected-docs", type=int, help="corpus size the partitions are sized for, default the sample corpus")
+    parser.add_argument("--collection", default="index_profile_bench", help="prefix of the couchbase collections and indexes")
+    parser.add_argument("--index-timeout", type=float, default=600, help="seconds to wait for each couchbase index to build")
+    parser.add_argument("--keep", action="store_true", help="keep the couchbase collections and indexes")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    texts = sample_corpus(args.pages)
+    questions = [question for question, _ in sample_questions(args.pages, args.queries)]
+
+    def embed(dims):
+        # The hashing stand-in is not trained to front-load information like
+        # text-embedding-3, so a smaller size hashes into fewer buckets instead
+        # of cutting off the tail of the full size vectors
+        embedding = HashingEmbeddings(dims=dims)
+        return (
+            np.asarray(embedding.embed_documents(texts), dtype=np.float32),
+            np.asarray(embedding.embed_documents(questions), dtype=np.float32),
+        )
+
+    # The truth is the exact top-k of the full size embeddings, so recall also
+    # counts what is lost by using smaller ones
+    truth = exact_top_k(*embed(args.full_dims), args.k)
+    expected_docs = args.expected_docs or len(texts)
+
+    bench = CouchbaseBench(args) if args.backend == "couchbase" else None
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for profile in args.profiles:
+                settings = index_settings(profile, min(PROFILES[profile]["dims"] or args.full_dims, args.full_dims), expected_docs)
+                profile_docs, profile_queries = embed(settings["dims"])
+                if bench:
+                    found, latencies = bench.run(settings, texts, profile_docs, profile_queries, args.k)
+                else:
+                    found, latencies = run_local(settings, texts, profile_docs, profile_queries, args.k, work_dir)
+                results.append({**settings, "recall_at_k": recall(found, truth), "latency_ms": percentiles(latencies)})
+    finally:
+        if bench and not args.keep:
+            bench.cleanup()
+
+    report = json.dumps({"config": vars(args), "documents": len(texts), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,10 @@
-import tempfile
-from langchain_couchbase import CouchbaseVectorStore
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import os
+import sys
+import time
 import streamlit as st
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
+import tracing
+from rag_pipeline import stream_answer, stream_rag_answer, stream_sequentially, stream_concurrently, format_timings
+from tenants import SHARED_TENANT, answer_mode, isolate_tenants, session_tenant, visible_tenants
 
 
 def check_environment_variable(variable_name):
@@ -20,25 +16,55 @@ def check_environment_variable(variable_name):
         st.stop()
 
 
-def save_to_vector_store(uploaded_file, vector_store):
-    """Chunk the PDF & store it in Couchbase Vector Store"""
+def save_to_vector_store(uploaded_file, vector_store, tenant=SHARED_TENANT):
+    """Chunk the PDF & store it in Couchbase Vector Store, tagged with the session's tenant"""
     if uploaded_file is not None:
-        temp_dir = tempfile.TemporaryDirectory()
-        temp_file_path = os.path.join(temp_dir.name, uploaded_file.name)
+        progress_bar = st.progress(0.0, text="Vectorizing PDF")
 
-        with open(temp_file_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-            loader = PyPDFLoader(temp_file_path)
-            docs = loader.load()
+        def show_progress(stats):
+            progress_bar.progress(
+                min(stats["pages"] / max(stats["total_pages"], 1), 1.0),
+                text=f"{stats['pages']}/{stats['total_pages']} pages, {stats['chunks']} documents stored, {stats['skipped']} already present",
+            )
+
+        from rag_factories import ingest_upload
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1500, chunk_overlap=150
+        stats = ingest_upload(
+            uploaded_file.name, uploaded_file.getvalue(), vector_store, progress=show_progress, tenant=tenant
         )
+        progress_bar.empty()
+        # A new upload with the same chunks leaves the generation, but changes the listed expiry
+        st.session_state.pop("documents", None)
+
+        st.info(
+            f"PDF loaded into vector store in {stats['chunks']} documents, {stats['skipped']} were already present, "
+            f"{stats['removed']} from its previous version removed "
+            f"({stats['pages_per_s']:.1f} pages/s, {stats['chunks_per_s']:.1f} documents/s)"
+        )
+        return stats
+
 
-        doc_pages = text_splitter.split_documents(docs)
+def show_documents(vector_store, tenant=SHARED_TENANT):
+    """List the PDFs the session's tenant loaded with a button to delete each one
 
-        vector_store.add_documents(doc_pages)
-        st.info(f"PDF loaded into vector store in {len(doc_pages)} documents")
+    The listing is read again only when the store's generation changes,
+    not on every rerun, and documents that expired since are left out.
+    """
+    from documents import is_expired, list_documents
+    from rag_factories import get_generation_counter, remove_upload
+
+    generation = get_generation_counter(vector_store)()
+    listing = st.session_state.get("documents")
+    if listing is None or listing[0] != (generation, tenant):
+        listing = st.session_state.documents = ((generation, tenant), list_documents(vector_store, [tenant]))
+    now = time.time()
+    for index, document in enumerate(d for d in listing[1] if not is_expired(d, now)):
+        name_column, delete_column = st.columns([4, 1])
+        name_column.caption(f"{document['source']} ({document['pages']} pages, {document['chunks']} documents)")
+        if delete_column.button("Delete", key=f"delete_document_{index}"):
+            deleted = remove_upload(document["source"], vector_store, tenant)
+            st.toast(f"Deleted '{document['source']}', {deleted} documents removed")
+            st.rerun()
 
 
 @st.cache_resource(show_spinner="Connecting to Vector Store")
@@ -50,38 +76,66 @@ def get_vector_store(
     _embedding,
     index_name,
 ):
-    """Return the Couchbase vector store"""
-    vector_store = CouchbaseVectorStore(
-        cluster=_cluster,
-        bucket_name=db_bucket,
-        scope_name=db_scope,
-        collection_name=db_collection,
-        embedding=_embedding,
-        index_name=index_name,
-    )
-    return vector_store
+    """Return the Couchbase vector store, or the local one when VECTOR_STORE=local"""
+    from rag_factories import make_vector_store
+
+    return make_vector_store(_cluster, db_bucket, db_scope, db_collection, _embedding, index_name)
+
+
+@st.cache_resource(show_spinner="Opening embedding cache")
+def get_embedding(cache_path):
+    """Return the OpenAI embeddings wrapped in the persistent embedding cache"""
+    from rag_factories import make_embedding
+
+    return make_embedding(cache_path)
+
+
+@st.cache_resource
+def get_answer_cache(_embedding, _vector_store):
+    """Return the answer cache shared by all sessions"""
+    from rag_factories import make_answer_cache
+
+    return make_answer_cache(_embedding, _vector_store)
+
+
+@st.cache_resource(show_spinner="Loading the LLM chains")
+def get_chains():
+    """Return the RAG and the pure LLM chain, built once per process"""
+    from rag_factories import build_pure_chain, build_rag_chain, make_llm
+
+    # Use OpenAI GPT 4 as the LLM for the RAG and for the pure LLM answer
+    return build_rag_chain(make_llm(temperature=0, streaming=True)), build_pure_chain(make_llm())
+
+
+@st.cache_resource
+def start_metrics_server(port, host):
+    """Serve the latency metrics of this process over HTTP, once per process"""
+    return tracing.serve_metrics(port, host)
 
 
 @st.cache_resource(show_spinner="Connecting to Couchbase")
-def connect_to_couchbase(connection_string, db_username, db_password):
-    """Connect to couchbase"""
-    from couchbase.cluster import Cluster
-    from couchbase.auth import PasswordAuthenticator
-    from couchbase.options import ClusterOptions
-    from datetime import timedelta
+def get_async_search_client(connection_string, db_username, db_password, db_bucket, db_scope, index_name, max_concurrency, timeout, retries):
+    """Return the async search client shared by all sessions"""
+    from rag_factories import make_async_search_client
 
-    auth = PasswordAuthenticator(db_username, db_password)
-    options = ClusterOptions(auth)
-    connect_string = "couchbases://" + connection_string + "/?ssl=no_verify"
-    cluster = Cluster(connect_string, options)
+    return make_async_search_client(connection_string, db_username, db_password, db_bucket, db_scope, index_name, max_concurrency, timeout, retries)
 
-    # Wait until the cluster is ready for use.
-    cluster.wait_until_ready(timedelta(seconds=5))
 
-    return cluster
+@st.cache_resource(show_spinner="Connecting to Couchbase")
+def connect_to_couchbase(connection_string, db_username, db_password):
+    """Connect to couchbase"""
+    import rag_factories
+
+    return rag_factories.connect_to_couchbase(connection_string, db_username, db_password)
 
 
 if __name__ == "__main__":
+    # Time each script run up to the chat input, cold runs also import the
+    # langchain stack and build the clients, see "Show latency metrics".
+    # Only cold starts are kept as traces, the many warm reruns would push
+    # the questions and uploads out of the recent traces
+    rerun_trace = tracing.Trace("rerun", cold="rag_factories" not in sys.modules)
+
     # Authorization
     if "auth" not in st.session_state:
         st.session_state.auth = False
@@ -110,6 +164,19 @@ if __name__ == "__main__":
         st.text_input("Enter password", type="password", key="password", on_change=authenticate)
         st.button("Submit", on_click=authenticate)
     else:
+        # The langchain, OpenAI and Couchbase modules are only needed once logged in
+        with rerun_trace.span("imports"):
+            import rag_factories
+
+        # Each browser session only retrieves its own uploads and the shared PDFs,
+        # unless TENANT_SCOPE=shared. The tenant is kept in the page URL, so
+        # reloading the page keeps the session's PDFs
+        if "tenant" not in st.session_state:
+            st.session_state.tenant = session_tenant(st.query_params.get("tenant"))
+            if st.session_state.tenant != SHARED_TENANT:
+                st.query_params["tenant"] = st.session_state.tenant
+        tenant = st.session_state.tenant
+
         # Load environment variables
         CB_HOSTNAME = os.getenv("CB_HOSTNAME")
         CB_USERNAME = os.getenv("CB_USERNAME")
@@ -120,67 +187,68 @@ if __name__ == "__main__":
         CB_SEARCHINDEX = os.getenv("CB_SEARCHINDEX")
 
         # Ensure that all environment variables are set
+        use_local_vector_store = rag_factories.use_local_vector_store()
         check_environment_variable("OPENAI_API_KEY")
-        check_environment_variable("CB_HOSTNAME")
-        check_environment_variable("CB_USERNAME")
-        check_environment_variable("CB_PASSWORD")
-        check_environment_variable("CB_BUCKET")
-        check_environment_variable("CB_SCOPE")
-        check_environment_variable("CB_COLLECTION")
-        check_environment_variable("CB_SEARCHINDEX")
-
-        # Use OpenAI Embeddings
-        embedding = OpenAIEmbeddings()
-
-        # Connect to Couchbase Vector Store
-        cluster = connect_to_couchbase(CB_HOSTNAME, CB_USERNAME, CB_PASSWORD)
-
-        vector_store = get_vector_store(
-            cluster,
-            CB_BUCKET,
-            CB_SCOPE,
-            CB_COLLECTION,
-            embedding,
-            CB_SEARCHINDEX,
-        )
-
-        # Use couchbase vector store as a retriever for RAG
-        retriever = vector_store.as_retriever()
-
-        # Build the prompt for the RAG
-        template = """You are a helpful bot. If you cannot answer based on the context provided, respond with a generic answer. Answer the question as truthfully as possible using the context below:
-        {context}
-
-        Question: {question}"""
-
-        prompt = ChatPromptTemplate.from_template(template)
-
-        # Use OpenAI GPT 4 as the LLM for the RAG
-        llm = ChatOpenAI(temperature=0, model="gpt-4-1106-preview", streaming=True)
-
-        # RAG chain
-        chain = (
-            {"context": retriever, "question": RunnablePassthrough()}
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
-
-        # Pure OpenAI output without RAG
-        template_without_rag = """You are a helpful bot. Answer the question as truthfully as possible.
-
-        Question: {question}"""
+        if not use_local_vector_store:
+            check_environment_variable("CB_HOSTNAME")
+            check_environment_variable("CB_USERNAME")
+            check_environment_variable("CB_PASSWORD")
+            check_environment_variable("CB_BUCKET")
+            check_environment_variable("CB_SCOPE")
+            check_environment_variable("CB_COLLECTION")
+            check_environment_variable("CB_SEARCHINDEX")
+        if isolate_tenants() and not rag_factories.document_ttl():
+            # A session's uploads can't be listed or deleted once its URL is lost, so they must expire
+            st.error("DOCUMENT_TTL=0 keeps uploads forever, which needs TENANT_SCOPE=shared. Set a DOCUMENT_TTL or TENANT_SCOPE=shared.")
+            st.stop()
+
+        # Connect to the stores and caches, each is only built on the first run
+        with rerun_trace.span("clients"):
+            # Optional JSON metrics endpoint at http://METRICS_HOST:METRICS_PORT/metrics
+            if os.getenv("METRICS_PORT"):
+                start_metrics_server(int(os.getenv("METRICS_PORT")), os.getenv("METRICS_HOST", "127.0.0.1"))
+
+            # Use OpenAI Embeddings behind a local cache, so unchanged text is never embedded twice
+            embedding = get_embedding(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite"))
+
+            # Connect to Couchbase Vector Store
+            cluster = None if use_local_vector_store else connect_to_couchbase(CB_HOSTNAME, CB_USERNAME, CB_PASSWORD)
+
+            vector_store = get_vector_store(
+                cluster,
+                CB_BUCKET,
+                CB_SCOPE,
+                CB_COLLECTION,
+                embedding,
+                CB_SEARCHINDEX,
+            )
 
-        prompt_without_rag = ChatPromptTemplate.from_template(template_without_rag)
+            # Answers to repeated or near duplicate questions are served from this cache
+            answer_cache = get_answer_cache(embedding, vector_store)
+
+            # Use couchbase vector store as a retriever for RAG, RETRIEVER_MODE=async sends
+            # the searches of all sessions through one bounded async client
+            search_client = None
+            if os.getenv("RETRIEVER_MODE") == "async" and not use_local_vector_store:
+                search_client = get_async_search_client(
+                    CB_HOSTNAME,
+                    CB_USERNAME,
+                    CB_PASSWORD,
+                    CB_BUCKET,
+                    CB_SCOPE,
+                    CB_SEARCHINDEX,
+                    int(os.getenv("SEARCH_MAX_CONCURRENCY", "16")),
+                    float(os.getenv("SEARCH_TIMEOUT", "5")),
+                    int(os.getenv("SEARCH_RETRIES", "2")),
+                )
+            retriever = rag_factories.make_retriever(vector_store, embedding, search_client, visible_tenants(tenant))
 
-        llm_without_rag = ChatOpenAI(model="gpt-4-1106-preview")
+            # Rerank, de-overlap and pack the retrieved chunks into a token budget
+            assemble = rag_factories.make_assemble(embedding)
 
-        chain_without_rag = (
-            {"question": RunnablePassthrough()}
-            | prompt_without_rag
-            | llm_without_rag
-            | StrOutputParser()
-        )
+        # The LLM clients, prompts and chains are built once per process
+        with rerun_trace.span("chains"):
+            chain, chain_without_rag = get_chains()
 
         # Frontend
         couchbase_logo = (
@@ -198,25 +266,62 @@ if __name__ == "__main__":
 
         with st.sidebar:
             st.header("Upload your PDF")
+            document_ttl = rag_factories.document_ttl()
             with st.form("upload pdf"):
                 uploaded_file = st.file_uploader(
                     "Choose a PDF.",
-                    help="The document will be deleted after one hour of inactivity (TTL).",
+                    help=(
+                        f"The document will be deleted after {document_ttl / 3600:g} hour(s) of inactivity (TTL). "
+                        "Uploading a new version of a PDF with the same file name replaces it."
+                        if document_ttl
+                        else "Uploading a new version of a PDF with the same file name replaces it."
+                    ),
                     type="pdf",
                 )
                 submitted = st.form_submit_button("Upload & Vectorize")
                 if submitted:
                     # store the PDF in the vector store after chunking
-                    save_to_vector_store(uploaded_file, vector_store)
+                    save_to_vector_store(uploaded_file, vector_store, tenant)
+
+            with st.expander("Loaded PDFs"):
+                show_documents(vector_store, tenant)
+
+            cache_stats = embedding.stats()
+            st.caption(
+                f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses"
+            )
+            retrieval_cache = rag_factories.get_retrieval_cache(vector_store)
+            if retrieval_cache is not None:
+                retrieval_stats = retrieval_cache.stats()
+                st.caption(
+                    f"Retrieval cache: {retrieval_stats['hits']} hits, {retrieval_stats['misses']} misses, "
+                    f"{retrieval_stats['bytes'] / 1e6:.1f} MB"
+                )
 
             st.subheader("How does it work?")
             use_pure_llm = st.checkbox("Use pure LLM (ChatGPT)", value=True, key="use_pure_llm_checkbox", on_change=lambda: st.session_state.update(clear_results=True, show_rag_button=False))
             use_rag = st.checkbox("Use RAG (vector query against Couchbase)", value=True, key="use_rag_checkbox", on_change=lambda: st.session_state.update(clear_results=True, show_rag_button=False))
+            run_concurrently = st.checkbox("Generate both answers at the same time", value=True, key="run_concurrently_checkbox")
 
             st.markdown(
                 "For RAG, we are using [Langchain](https://langchain.com/), [Couchbase Vector Search](https://couchbase.com/) & [OpenAI](https://openai.com/). We fetch parts of the PDF relevant to the question using Vector search & add it as the context to the LLM. The LLM is instructed to answer based on the context from the Vector Store."
             )
 
+            # Latency of the recent questions and uploads handled by this process
+            if st.checkbox("Show latency metrics"):
+                metrics = tracing.summarize()
+                cold_starts = [t for t in tracing.recent_traces if t.name == "rerun"]
+                if "last_rerun_ms" in st.session_state:
+                    st.caption(
+                        f"Last rerun {st.session_state.last_rerun_ms:.0f} ms"
+                        + (f", last cold start {cold_starts[-1].duration * 1000:.0f} ms" if cold_starts else "")
+                    )
+                st.dataframe(
+                    [{"stage": name, **values} for name, values in metrics["spans"].items()],
+                    hide_index=True,
+                )
+                st.json(metrics["counters"], expanded=False)
+
             # View Code
             if st.checkbox("View Code"):
                 st.write(
@@ -235,6 +340,9 @@ if __name__ == "__main__":
         if "rag_context" not in st.session_state:
             st.session_state.rag_context = ""
 
+        if "rag_timings" not in st.session_state:
+            st.session_state.rag_timings = ""
+
         # Reset show_rag_button if RAG is unchecked
         if not use_rag:
             st.session_state.show_rag_button = False
@@ -253,6 +361,11 @@ if __name__ == "__main__":
             with st.chat_message(message["role"], avatar=message["avatar"]):
                 st.markdown(message["content"])
 
+        if rerun_trace.attrs["cold"]:
+            rerun_trace.finish()
+        else:
+            st.session_state.last_rerun_ms = (time.time() - rerun_trace.started) * 1000
+
         # React to user input
         if question := st.chat_input("Ask a question based on the PDF(s)"):
             # Clear results area on new question
@@ -267,57 +380,84 @@ if __name__ == "__main__":
                 {"role": "user", "content": question, "avatar": openai_logo}
             )
 
-            if use_pure_llm:
-                # Stream the response from the pure LLM
-                with st.chat_message("assistant", avatar=openai_logo):
-                    message_placeholder_pure_llm = st.empty()
-
-                pure_llm_response = ""
-                for chunk in chain_without_rag.stream(question):
-                    pure_llm_response += chunk
-                    message_placeholder_pure_llm.markdown(pure_llm_response + "â")
-
-                message_placeholder_pure_llm.markdown(pure_llm_response)
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant",
-                        "content": pure_llm_response,
-                        "avatar": openai_logo,
-                    }
-                )
-
-            if use_rag:
-                # Reset show_rag_button to False before processing
-                st.session_state.show_rag_button = False
-
-                # Capture context and question for display
-                relevant_docs = retriever.invoke(question)
-                context = "\n".join([doc.page_content for doc in relevant_docs])
-                rag_context = {"context": context, "question": question}
-
-                # Save context in session state
-                st.session_state.rag_context = str(rag_context)
-
-                # Stream the response from the RAG
-                with st.chat_message("assistant", avatar=couchbase_logo):
-                    message_placeholder = st.empty()
-
-                rag_response = ""
-                for chunk in chain.stream(question):
-                    rag_response += chunk
-                    message_placeholder.markdown(rag_response + "â")
-
-                message_placeholder.markdown(rag_response)
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant",
-                        "content": rag_response,
-                        "avatar": couchbase_logo,
-                    }
-                )
-
-                # Show the button after RAG response is processed
-                st.session_state.show_rag_button = True
+            # Trace the stages of answering, for the metrics panel, endpoint and log
+            with tracing.trace("question", pure_llm=use_pure_llm, rag=use_rag) as question_trace:
+                timings = {}
+                rag_context = {}
+                placeholders = {}
+                streams = {}
+                cached = {}
+                # Read before retrieving, so an answer racing an upload is not cached as current
+                generation = answer_cache.generation()
+
+                if use_pure_llm:
+                    # Stream the response from the pure LLM
+                    with st.chat_message("assistant", avatar=openai_logo):
+                        placeholders["pure"] = st.empty()
+                    cached["pure"] = answer_cache.get(answer_mode("pure", tenant), question)
+                    if cached["pure"] is None:
+                        streams["pure"] = lambda: stream_answer(chain_without_rag, question, timings, prefix="pure_")
+
+                if use_rag:
+                    # Reset show_rag_button to False before processing
+                    st.session_state.show_rag_button = False
+
+                    # Stream the response from the RAG, retrieving once so the same
+                    # documents are shown and sent to the LLM
+                    with st.chat_message("assistant", avatar=couchbase_logo):
+                        placeholders["rag"] = st.empty()
+                    cached["rag"] = answer_cache.get(answer_mode("rag", tenant), question)
+                    if cached["rag"] is None:
+                        streams["rag"] = lambda: stream_rag_answer(retriever, chain, question, timings, rag_context, assemble)
+                    else:
+                        rag_context.update(cached["rag"]["context"])
+
+                # Cached answers are shown right away, the others are streamed into
+                # their placeholders as tokens arrive
+                responses = {
+                    name: cached[name]["answer"] if cached[name] else "" for name in placeholders
+                }
+                for name in placeholders:
+                    if cached[name]:
+                        placeholders[name].markdown(responses[name])
+                stream_all = stream_concurrently if run_concurrently else stream_sequentially
+                for name, chunk in stream_all(streams):
+                    responses[name] += chunk
+                    with question_trace.timed("render"):
+                        placeholders[name].markdown(responses[name] + "â")
+
+                avatars = {"pure": openai_logo, "rag": couchbase_logo}
+                for name, response in responses.items():
+                    placeholders[name].markdown(response)
+                    if name in streams:
+                        answer_cache.put(
+                            answer_mode(name, tenant),
+                            question,
+                            response,
+                            dict(rag_context) if name == "rag" else None,
+                            generation,
+                        )
+                    else:
+                        timings[name + "_cache_hit"] = 0.0
+                    st.session_state.messages.append(
+                        {
+                            "role": "assistant",
+                            "content": response,
+                            "avatar": avatars[name],
+                        }
+                    )
+
+                for name, value in timings.items():
+                    if isinstance(value, int):
+                        question_trace.count(name, value)
+
+                if use_rag:
+                    # Save context in session state
+                    st.session_state.rag_context = str(rag_context)
+                    st.session_state.rag_timings = format_timings(timings)
+
+                    # Show the button after RAG response is processed
+                    st.session_state.show_rag_button = True
 
         # Add hyperlink to view context if RAG is used
         if use_rag and st.session_state.show_rag_button:
@@ -326,4 +466,5 @@ if __name__ == "__main__":
 
         if use_rag and st.session_state.show_rag_context:
             st.text_area("RAG Context Sent to LLM", value=st.session_state.rag_context, height=400, max_chars=None)
+            st.caption(st.session_state.rag_timings)
 
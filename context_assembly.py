@@ -0,0 +1,84 @@
+from functools import lru_cache
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+TOKEN_BUDGET = 2000
+MIN_OVERLAP = 20
+MAX_OVERLAP = 400
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding of the model"""
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text, model="gpt-4-1106-preview"):
+    """Count the tokens the model sees for the text"""
+    return len(get_encoding(model).encode(text))
+
+
+def overlap_length(head, tail, max_chars=MAX_OVERLAP):
+    """Return the length of the longest end of `head` that `tail` starts with"""
+    for n in range(min(max_chars, len(head), len(tail)), MIN_OVERLAP - 1, -1):
+        if head.endswith(tail[:n]):
+            return n
+    return 0
+
+
+def remove_overlap(texts):
+    """Drop duplicate chunks and trim text a chunk shares with the start or end of another one
+
+    The splitter repeats up to `chunk_overlap` characters between adjacent
+    chunks, so when both neighbours are retrieved that text is only kept once.
+    """
+    kept = []
+    for text in texts:
+        if any(text in other for other in kept):
+            continue
+        for other in kept:
+            text = text[overlap_length(other, text):]
+            n = overlap_length(text, other)
+            if n:
+                text = text[:-n]
+        if text.strip():
+            kept.append(text)
+    return kept
+
+
+def assemble_context(question, docs, timings, embedding=None, token_budget=TOKEN_BUDGET, lambda_mult=0.5, model="gpt-4-1106-preview"):
+    """Build the RAG context from the retrieved documents within a token budget
+
+    The documents are ordered by maximal marginal relevance, so the most
+    relevant text comes first and near duplicates are pushed back, then
+    overlapping text is removed and chunks are packed until the budget is
+    used up. The vectors are looked up in `embedding`, the cached embedding
+    used for ingest and retrieval. If any of them is not cached (or
+    `embedding` has no cache), the retrieval order is kept rather than
+    calling the embedding API for every question. Token counts before and
+    after, and whether MMR reordered the documents, are recorded in `timings`.
+    """
+    texts = [doc.page_content for doc in docs]
+    timings["mmr"] = 0
+    if hasattr(embedding, "lookup") and len(texts) > 1:
+        vectors = embedding.lookup([question] + texts)
+        if all(vector is not None for vector in vectors):
+            order = maximal_marginal_relevance(np.asarray(vectors[0]), vectors[1:], lambda_mult, len(texts))
+            texts = [texts[i] for i in order]
+            timings["mmr"] = 1
+
+    context = []
+    used = 0
+    for text in remove_overlap(texts):
+        tokens = count_tokens(text, model)
+        if used + tokens <= token_budget:
+            context.append(text)
+            used += tokens
+
+    timings["retrieved_tokens"] = sum(count_tokens(doc.page_content, model) for doc in docs)
+    timings["context_tokens"] = used
+    timings["tokens_saved"] = timings["retrieved_tokens"] - used
+    return "\n".join(context)
@@ -0,0 +1,320 @@
+import hashlib
+import math
+import time
+from datetime import timedelta
+
+import tracing
+from tenants import SHARED_TENANT
+
+MANIFEST_PREFIX = "manifest::"
+REGISTRY_PREFIX = "manifest::_registry::"
+TENANTS_ID = "manifest::_tenants"
+GENERATION_ID = "manifest::_generation"
+
+
+def expires_at(ttl):
+    """Return when something written now with a `ttl` in seconds expires, as epoch seconds, or None"""
+    return time.time() + ttl if ttl else None
+
+
+def document_key(source, tenant=SHARED_TENANT):
+    """Return what identifies the named source document of a tenant, tenants may each have a `manual.pdf`"""
+    return source if tenant == SHARED_TENANT else tenant + "\0" + source
+
+
+def manifest_id(source, tenant=SHARED_TENANT):
+    """Return the ID of the manifest of the named source document"""
+    return MANIFEST_PREFIX + hashlib.sha256(document_key(source, tenant).encode("utf-8")).hexdigest()
+
+
+def _collection(vector_store):
+    # A CouchbaseVectorStore, or a Collection for callers without embeddings such as setup.py
+    return getattr(vector_store, "_collection", vector_store)
+
+
+def _tenant_hash(tenant):
+    return hashlib.sha256(tenant.encode("utf-8")).hexdigest()
+
+
+def registry_id(tenant=SHARED_TENANT):
+    """Return the ID of the registry listing the documents of a tenant, each tenant has its own"""
+    return REGISTRY_PREFIX + _tenant_hash(tenant)
+
+
+def _registry_key(id):
+    return id[len(MANIFEST_PREFIX) :]
+
+
+def is_expired(summary, now=None):
+    """Return True if the manifest or its summary has an expiry that has passed"""
+    return bool(summary.get("expires_at")) and summary["expires_at"] <= (time.time() if now is None else now)
+
+
+def touch_chunks(vector_store, ids, ttl):
+    """Restart the expiry of stored chunks, e.g. when their document is uploaded again"""
+    if not ids or not ttl:
+        return
+    if hasattr(vector_store, "touch"):
+        vector_store.touch(ids, ttl)
+        return
+
+    result = _collection(vector_store).touch_multi(list(ids), timedelta(seconds=ttl))
+    if not result.all_ok:
+        raise ValueError(f"Failed to touch documents: {result.exceptions}")
+
+
+def delete_chunks(vector_store, ids):
+    """Delete chunks by ID, returning how many were asked for, IDs that already expired are ignored"""
+    if not ids:
+        return 0
+    with tracing.span("delete", documents=len(ids)):
+        if hasattr(vector_store, "manifests"):
+            vector_store.delete(list(ids))
+        else:
+            from couchbase.exceptions import DocumentNotFoundException
+
+            result = _collection(vector_store).remove_multi(list(ids))
+            failed = {id: e for id, e in result.exceptions.items() if not isinstance(e, DocumentNotFoundException)}
+            if failed:
+                raise ValueError(f"Failed to delete documents: {failed}")
+    return len(ids)
+
+
+def get_manifest(vector_store, source, tenant=SHARED_TENANT):
+    """Return the manifest of the source document with the IDs of its chunks, or None"""
+    if hasattr(vector_store, "manifests"):
+        return vector_store.get_manifest(manifest_id(source, tenant))
+
+    from couchbase.exceptions import DocumentNotFoundException
+
+    try:
+        return _collection(vector_store).get(manifest_id(source, tenant)).content_as[dict]
+    except DocumentNotFoundException:
+        return None
+
+
+def put_manifest(vector_store, manifest, ttl=None):
+    """Store the manifest, expiring with its chunks, and list it in the tenant's registry of documents"""
+    id = manifest_id(manifest["source"], manifest["tenant"])
+    if hasattr(vector_store, "manifests"):
+        vector_store.put_manifest(id, manifest)
+        return
+
+    from couchbase.options import UpsertOptions
+
+    collection = _collection(vector_store)
+    options = UpsertOptions(expiry=timedelta(seconds=ttl)) if ttl else UpsertOptions()
+    collection.upsert(id, manifest, options)
+    summary = {key: value for key, value in manifest.items() if key != "ids"}
+    _update_registry(collection, manifest["tenant"], lambda sources: sources.update({_registry_key(id): summary}))
+
+
+def remove_manifest(vector_store, source, tenant=SHARED_TENANT):
+    """Drop the manifest of the source document and its registry entry"""
+    id = manifest_id(source, tenant)
+    if hasattr(vector_store, "manifests"):
+        vector_store.delete_manifest(id)
+        return
+
+    from couchbase.exceptions import DocumentNotFoundException
+
+    collection = _collection(vector_store)
+    try:
+        collection.remove(id)
+    except DocumentNotFoundException:
+        pass
+    _update_registry(collection, tenant, lambda sources: sources.pop(_registry_key(id), None))
+
+
+def _registry_expiry(sources, now):
+    # The registry lives as long as its last document, and forever with a document that doesn't expire
+    expiries = [summary.get("expires_at") for summary in sources.values()]
+    if not expiries or None in expiries:
+        return {}
+    return {"expiry": timedelta(seconds=math.ceil(max(expiries) - now) + 1)}
+
+
+def _update_registry(collection, tenant, update):
+    """Apply `update` to the live entries of the tenant's registry and return them
+
+    The registry is rewritten as a whole, guarded by its CAS, without the
+    entries of expired documents. It expires with the last of its
+    documents and is removed once it has none left, so the registries of
+    tenants that stopped uploading don't pile up.
+    """
+    from couchbase.exceptions import CasMismatchException, DocumentExistsException, DocumentNotFoundException
+    from couchbase.options import InsertOptions, RemoveOptions, ReplaceOptions
+
+    id = registry_id(tenant)
+    while True:
+        try:
+            result = collection.get(id)
+            sources, cas = result.content_as[dict].get("sources", {}), result.cas
+        except DocumentNotFoundException:
+            sources, cas = {}, None
+        now = time.time()
+        live = {key: summary for key, summary in sources.items() if not is_expired(summary, now)}
+        update(live)
+        if live == sources:
+            return live
+        registry = {"tenant": tenant, "sources": live}
+        try:
+            if not live:
+                collection.remove(id, RemoveOptions(cas=cas))
+            elif cas is None:
+                collection.insert(id, registry, InsertOptions(**_registry_expiry(live, now)))
+                _add_tenant(collection, tenant)
+            else:
+                collection.replace(id, registry, ReplaceOptions(cas=cas, **_registry_expiry(live, now)))
+            return live
+        except (CasMismatchException, DocumentExistsException, DocumentNotFoundException):
+            # Another writer changed the registry in between, apply the update to its version
+            continue
+
+
+def _add_tenant(collection, tenant):
+    # Listed once per registry, for the listing of every tenant's documents
+    import couchbase.subdocument as SD
+    from couchbase.options import MutateInOptions
+
+    collection.mutate_in(
+        TENANTS_ID,
+        [SD.upsert("tenants." + _tenant_hash(tenant), tenant, create_parents=True)],
+        MutateInOptions(store_semantics=SD.StoreSemantics.UPSERT),
+    )
+
+
+def _prune_tenants(collection, cas, tenants):
+    # Drops tenants without a registry, unless the list changed since it was read, e.g. one uploaded again
+    import couchbase.subdocument as SD
+    from couchbase.exceptions import CasMismatchException, PathNotFoundException
+    from couchbase.options import MutateInOptions
+
+    try:
+        collection.mutate_in(
+            TENANTS_ID, [SD.remove("tenants." + _tenant_hash(tenant)) for tenant in tenants], MutateInOptions(cas=cas)
+        )
+    except (CasMismatchException, PathNotFoundException):
+        pass
+
+
+def list_documents(vector_store, tenants=None):
+    """Return the summaries of the stored documents of `tenants` (default all) that have not expired, sorted by source
+
+    Only the registries of `tenants` are read, and the entries of documents
+    that expired are removed from them, so they hold the live documents.
+    Listing every tenant also forgets the tenants left without documents.
+    """
+    now = time.time()
+    if hasattr(vector_store, "manifests"):
+        summaries = []
+        for id, manifest in vector_store.manifests().items():
+            if is_expired(manifest, now):
+                vector_store.delete_manifest(id)
+            elif tenants is None or manifest["tenant"] in tenants:
+                summaries.append({key: value for key, value in manifest.items() if key != "ids"})
+        return sorted(summaries, key=lambda s: s["source"])
+
+    from couchbase.exceptions import DocumentNotFoundException
+
+    collection = _collection(vector_store)
+    listed = None
+    if tenants is None:
+        try:
+            listed = collection.get(TENANTS_ID)
+            tenants = list(listed.content_as[dict].get("tenants", {}).values())
+        except DocumentNotFoundException:
+            tenants = []
+    summaries = []
+    empty = []
+    for tenant in dict.fromkeys(tenants):
+        live = _update_registry(collection, tenant, lambda sources: None)
+        summaries.extend(live.values())
+        if not live:
+            empty.append(tenant)
+    if listed is not None and empty:
+        _prune_tenants(collection, listed.cas, empty)
+    return sorted(summaries, key=lambda s: s["source"])
+
+
+def replace_document(vector_store, source, version, ids, pages, ttl=None, tenant=SHARED_TENANT):
+    """Record `ids` as the chunks of the tenant's source document and delete the ones only its previous version had
+
+    Returns how many stale chunks were deleted. The chunks of other
+    documents, and the chunks the two versions share, are not touched.
+    """
+    previous = get_manifest(vector_store, source, tenant)
+    stale = set(previous["ids"]) - set(ids) if previous else set()
+    put_manifest(
+        vector_store,
+        {
+            "source": source,
+            "tenant": tenant,
+            "version": version,
+            "ids": list(ids),
+            "pages": pages,
+            "chunks": len(ids),
+            "ingested_at": time.time(),
+            "expires_at": expires_at(ttl),
+        },
+        ttl,
+    )
+    return delete_chunks(vector_store, stale)
+
+
+def get_generation(vector_store):
+    """Return the generation counter of the vector store's documents, 0 until it is first bumped"""
+    if hasattr(vector_store, "manifests"):
+        return vector_store.generation
+
+    from couchbase.exceptions import DocumentNotFoundException
+
+    try:
+        return _collection(vector_store).get(GENERATION_ID).content_as[int]
+    except DocumentNotFoundException:
+        return 0
+
+
+class GenerationCounter:
+    """Reads the vector store's generation counter at most every `check_interval` seconds
+
+    Caches of this process call it on every lookup and compare the result
+    with the generation their entries were made at, so documents added or
+    removed by any process invalidate them within `check_interval`.
+    """
+
+    def __init__(self, vector_store, check_interval=1.0):
+        self.vector_store = vector_store
+        self.check_interval = check_interval
+        self._generation = None
+        self._checked = 0.0
+
+    def __call__(self):
+        """Return the generation, re-reading it if it is older than `check_interval`"""
+        now = time.monotonic()
+        if self._generation is None or now - self._checked >= self.check_interval:
+            self._generation = get_generation(self.vector_store)
+            self._checked = now
+        return self._generation
+
+    def recheck(self):
+        """Re-read the generation on the next call, e.g. right after this process bumped it"""
+        self._checked = 0.0
+
+
+def bump_generation(vector_store):
+    """Increment the generation counter after documents were added or removed, so cached searches are dropped"""
+    if hasattr(vector_store, "manifests"):
+        return vector_store.bump_generation()
+
+    from couchbase.options import IncrementOptions, SignedInt64
+
+    return _collection(vector_store).binary().increment(GENERATION_ID, IncrementOptions(initial=SignedInt64(1))).content
+
+
+def delete_document(vector_store, source, tenant=SHARED_TENANT):
+    """Delete every chunk of the tenant's source document and its manifest, returning how many chunks were deleted"""
+    manifest = get_manifest(vector_store, source, tenant)
+    deleted = delete_chunks(vector_store, manifest["ids"]) if manifest else 0
+    remove_manifest(vector_store, source, tenant)
+    return deleted
@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+import tracing
+
+
+class BatchingEmbeddings(Embeddings):
+    """Coalesces concurrent embedding requests into batched calls to another Embeddings object
+
+    Requests from every thread (questions and ingest batches) are collected
+    for up to `max_wait` seconds after the first one arrives, or until
+    `max_batch` texts are waiting, and sent as one `embed_documents` call.
+    Identical texts in a batch are only embedded once and each caller gets
+    its own vectors back. At most `max_concurrency` batched calls are in
+    flight, so a slow call doesn't stop the next batch from being collected.
+    """
+
+    def __init__(self, embedding, max_batch=256, max_wait=0.005, max_concurrency=8):
+        self.embedding = embedding
+        # The embedding cache keys its vectors by these
+        self.model = getattr(embedding, "model", type(embedding).__name__)
+        self.dimensions = getattr(embedding, "dimensions", None)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embedding_batch")
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self):
+        carry = None
+        while True:
+            batch = [carry or self._queue.get()]
+            carry = None
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if size + len(request[0]) > self.max_batch:
+                    # Starts the next batch, a request larger than max_batch is sent on its own
+                    carry = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._pool.submit(self._send, batch)
+
+    def _send(self, batch):
+        unique = list(dict.fromkeys(text for texts, _ in batch for text in texts))
+        with self._lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.texts += len(unique)
+        try:
+            vectors = dict(zip(unique, self.embedding.embed_documents(unique)))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for texts, future in batch:
+            future.set_result(([vectors[text] for text in texts], len(batch)))
+
+    def embed_documents(self, texts):
+        """Embed the texts in the next batch, waiting for its result"""
+        texts = list(texts)
+        if not texts:
+            return []
+        future = Future()
+        self._queue.put((texts, future))
+        vectors, requests = future.result()
+        tracing.count("embedding_batch_requests", requests)
+        return vectors
+
+    def embed_query(self, text):
+        """Embed a query in the next batch, waiting for its result"""
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        """Return how many requests were sent in how many batched calls"""
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "texts": self.texts,
+            "requests_per_batch": self.requests / self.batches if self.batches else 0.0,
+        }
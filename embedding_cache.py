@@ -0,0 +1,142 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+import tracing
+
+
+class CachedEmbeddings(Embeddings):
+    """Content addressed embedding cache in front of another Embeddings object
+
+    Vectors are keyed by the model name (and its truncated `dimensions`, if
+    any) and a hash of the text. Lookups go to
+    an in-process LRU first, then to a SQLite file on local disk holding the
+    vectors as float32 blobs. Only misses are sent to the wrapped embedding.
+    """
+
+    def __init__(self, embedding, path="embedding_cache.sqlite", max_entries=200000, memory_entries=2048):
+        self.embedding = embedding
+        self.model = getattr(embedding, "model", type(embedding).__name__)
+        if getattr(embedding, "dimensions", None):
+            self.model += f"@{embedding.dimensions}"
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._db.commit()
+
+    def _key(self, text):
+        return hashlib.sha256((self.model + "\0" + text).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """Return the cached vectors for the keys, None where the key is not cached"""
+        found = {}
+        on_disk = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                found[key] = self._memory[key]
+            else:
+                on_disk.append(key)
+
+        now = time.time()
+        for i in range(0, len(on_disk), 500):
+            batch = on_disk[i : i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, blob in rows:
+                vector = array("f", blob).tolist()
+                found[key] = vector
+                self._remember(key, vector)
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+            )
+        self._db.commit()
+        return [found.get(key) for key in keys]
+
+    def _store(self, keys, vectors):
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            [(key, array("f", vector).tobytes(), now) for key, vector in zip(keys, vectors)],
+        )
+        for key, vector in zip(keys, vectors):
+            self._remember(key, vector)
+
+        # Evict the least recently used vectors once the cache is over its size bound
+        (count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        self._db.commit()
+
+    def _embed(self, texts, embed_missing):
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            vectors = self._lookup(keys)
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        tracing.count("embedding_cache_hits", len(texts) - len(missing))
+        tracing.count("embedding_cache_misses", len(missing))
+        if missing:
+            # Identical texts in one call are only embedded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            with tracing.span("embedding_api", texts=len(unique)):
+                embedded = embed_missing(unique)
+            # Round trip through float32 so hits and misses return identical vectors
+            new_vectors = {
+                text: array("f", vector).tolist() for text, vector in zip(unique, embedded)
+            }
+            with self._lock:
+                self._store([self._key(text) for text in unique], [new_vectors[text] for text in unique])
+            for i in missing:
+                vectors[i] = new_vectors[texts[i]]
+        return vectors
+
+    def embed_documents(self, texts):
+        """Embed the texts, only calling the wrapped embedding for cache misses"""
+        return self._embed(list(texts), self.embedding.embed_documents)
+
+    def embed_query(self, text):
+        """Embed a query, only calling the wrapped embedding on a cache miss"""
+        return self._embed([text], lambda texts: [self.embedding.embed_query(texts[0])])[0]
+
+    def lookup(self, texts):
+        """Return the cached vectors of the texts, None where a text is not cached, without calling the wrapped embedding"""
+        with self._lock:
+            return self._lookup([self._key(text) for text in texts])
+
+    def stats(self):
+        """Return the hit and miss counters"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from async_retrieval import AsyncSearchClient
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic offline stand-in for OpenAIEmbeddings
+
+    Each word is hashed into one of `dims` signed buckets and the vector is
+    L2 normalized, so texts sharing words score high under dot product and
+    retrieval quality can be checked without calling OpenAI. `latency`
+    seconds are slept per call to imitate the API round trip.
+    """
+
+    def __init__(self, dims=1536, latency=0.0):
+        self.dims = dims
+        self.latency = latency
+        self.model = f"hashing-{dims}"
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16)
+            vector[digest % self.dims] += 1.0 if digest & (1 << 31) else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        """Embed the texts, sleeping once for the whole batch"""
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        """Embed a single query"""
+        return self.embed_documents([text])[0]
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Offline stand-in for ChatOpenAI that streams a canned answer word by word
+
+    The first token arrives after `first_token_latency` seconds and each
+    following one after `token_latency` seconds.
+    """
+
+    answer: str = " ".join(["token"] * 50)
+    first_token_latency: float = 0.2
+    token_latency: float = 0.01
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        words = self.answer.split(" ")
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == len(words) - 1 else word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+class NullAnswerCache:
+    """Answer cache stand-in that never hits, so every question runs the chains"""
+
+    def generation(self):
+        return None
+
+    def get(self, mode, question):
+        return None
+
+    def put(self, mode, question, answer, context=None, generation=None):
+        pass
+
+
+WORDS = (
+    "couchbase vector search index bucket scope collection document cluster node query "
+    "embedding model prompt answer context chunk page manual install configure replica "
+    "memory disk network latency throughput backup restore security user role password"
+).split()
+
+
+def sample_page_text(page, lines=40):
+    """Return deterministic text for a page of the sample corpus, tagged with a `topicN` marker word"""
+    text = []
+    for line in range(lines):
+        words = [WORDS[(page * 7 + line * 3 + i) % len(WORDS)] for i in range(10)]
+        text.append(" ".join(words) + f" topic{page} section{line}")
+    return text
+
+
+def write_sample_pdf(file_path, pages, lines=40):
+    """Write a plain text PDF of the sample corpus, one content stream per page"""
+    out = [b"%PDF-1.4\n"]
+    offsets = {}
+
+    def add(number, content):
+        offsets[number] = sum(len(part) for part in out)
+        out.append(f"{number} 0 obj\n".encode() + content + b"\nendobj\n")
+
+    page_numbers = [4 + 2 * page for page in range(pages)]
+    kids = " ".join(f"{number} 0 R" for number in page_numbers)
+    add(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    add(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    add(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for page, number in enumerate(page_numbers):
+        stream = "\n".join(
+            f"BT /F1 8 Tf 20 {780 - line * 18} Td ({text}) Tj ET"
+            for line, text in enumerate(sample_page_text(page, lines))
+        ).encode()
+        add(number, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {number + 1} 0 R >>"
+        ).encode())
+        add(number + 1, f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+
+    xref = sum(len(part) for part in out)
+    out.append(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+    out.extend(f"{offsets[number]:010d} 00000 n \n".encode() for number in sorted(offsets))
+    out.append(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    with open(file_path, "wb") as f:
+        f.write(b"".join(out))
+
+
+def prefilter_tenants(prefilter):
+    """Return the tenants a kNN prefilter built by `tenant_filter` matches, or None for no prefilter"""
+    if prefilter is None:
+        return None
+    encoded = prefilter.encodable
+    return [query["term"] for query in encoded.get("disjuncts", [encoded])]
+
+
+class FakeAsyncSearchClient(AsyncSearchClient):
+    """AsyncSearchClient answering from a LocalVectorStore after `latency` seconds instead of Couchbase"""
+
+    def __init__(self, local_store, latency=0.02, **kwargs):
+        super().__init__(None, None, None, None, None, **kwargs)
+        self.local_store = local_store
+        self.latency = latency
+
+    async def _execute(self, search_req, k):
+        await asyncio.sleep(self.latency)
+        query = search_req.vector_search.queries[0]
+        rows = []
+        for row, score in self.local_store.search_by_vectors([query.vector], k, prefilter_tenants(query.prefilter))[0]:
+            doc = self.local_store._to_document(row)
+            fields = {"metadata." + key: value for key, value in doc.metadata.items()}
+            rows.append((doc.id, {"text": doc.page_content, **fields}, score))
+        return rows
@@ -0,0 +1,94 @@
+import re
+from typing import Any, List, Optional
+
+from couchbase import search
+from couchbase.options import SearchOptions
+from couchbase.vector_search import VectorQuery, VectorSearch
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import tracing
+from tenants import tenant_filter
+
+
+def is_keyword_query(query):
+    """Return True for short, ID-like queries such as "ERR-1234" or "RFC 7231" """
+    tokens = query.split()
+    return 1 <= len(tokens) <= 3 and any(re.search(r"\d", token) for token in tokens)
+
+
+class VectorRetriever(BaseRetriever):
+    """Vector kNN retriever over a CouchbaseVectorStore that only searches the documents of `tenants`
+
+    The tenant filter is applied inside the kNN query (a prefilter), so the
+    search only scores the tenants' vectors and still returns `k` of them.
+    Without `tenants` it searches every document like `as_retriever()`.
+    """
+
+    vector_store: Any
+    k: int = 4
+    tenants: Optional[List[str]] = None
+
+    def _filtered(self, query):
+        """Return the text query restricted to the documents of `tenants`"""
+        if not self.tenants:
+            return query
+        return search.ConjunctionQuery(query, tenant_filter(self.tenants))
+
+    def _vector_search(self, query_embedding, boost=None):
+        return VectorSearch.from_vector_query(
+            VectorQuery(
+                self.vector_store._embedding_key,
+                query_embedding,
+                num_candidates=self.k,
+                boost=boost,
+                prefilter=tenant_filter(self.tenants),
+            )
+        )
+
+    def _search(self, search_req):
+        store = self.vector_store
+        options = SearchOptions(limit=self.k, fields=["*"])
+        with tracing.span("vector_search"):
+            if store._scoped_index:
+                search_iter = store._scope.search(store._index_name, search_req, options)
+            else:
+                search_iter = store._cluster.search(store._index_name, search_req, options)
+
+            docs = []
+            for row in search_iter.rows():
+                text = row.fields.pop(store._text_key, "")
+                docs.append(Document(id=row.id, page_content=text, metadata=store._format_metadata(row.fields)))
+        return docs
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        query_embedding = self.vector_store.embeddings.embed_query(query)
+        return self._search(search.SearchRequest.create(self._vector_search(query_embedding)))
+
+
+class HybridRetriever(VectorRetriever):
+    """Retriever combining a text match on `text` with the vector kNN in one Couchbase search request
+
+    The scores of the two queries are weighted with `text_weight` and
+    `vector_weight`. Short, ID-like queries first try an exact phrase match
+    on the text alone, which needs no embedding call, and only fall back to
+    the hybrid search when that finds nothing. Both queries only match the
+    documents of `tenants`, if given.
+    """
+
+    text_weight: float = 0.3
+    vector_weight: float = 1.0
+    keyword_fast_path: bool = True
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        text_key = self.vector_store._text_key
+        if self.keyword_fast_path and is_keyword_query(query):
+            docs = self._search(search.SearchRequest.create(self._filtered(search.MatchPhraseQuery(query, field=text_key))))
+            if docs:
+                return docs
+
+        query_embedding = self.vector_store.embeddings.embed_query(query)
+        search_req = search.SearchRequest.create(
+            self._filtered(search.MatchQuery(query, field=text_key, boost=self.text_weight))
+        ).with_vector_search(self._vector_search(query_embedding, boost=self.vector_weight))
+        return self._search(search_req)
@@ -0,0 +1,99 @@
+import json
+import math
+import os
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+DEFAULT_DIMS = 1536
+DOCS_PER_PARTITION = 500000
+MAX_PARTITIONS = 32
+
+# Named search index tunings, `dims` None keeps the embedding model's full size
+PROFILES = {
+    # The template's defaults, the best neighbours at a higher query cost
+    "recall": {"optimized_for": "recall", "dims": None},
+    # Probes fewer clusters per query, trading a little recall for latency
+    "latency": {"optimized_for": "latency", "dims": None},
+    # Latency optimized over vectors truncated to 512 dims, a third of the memory
+    # and scan cost, needs a text-embedding-3 model with EMBEDDING_DIMS=512
+    "compact": {"optimized_for": "latency", "dims": 512},
+}
+
+
+def partitions_for(expected_docs):
+    """Return the index partition count for a corpus of about `expected_docs` chunks"""
+    return max(1, min(MAX_PARTITIONS, math.ceil(expected_docs / DOCS_PER_PARTITION)))
+
+
+def index_settings(profile="recall", dims=None, expected_docs=0):
+    """Return the optimized_for, dims and partitions of a profile, `dims` overrides the profile's"""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown index profile '{profile}', expected one of {', '.join(PROFILES)}")
+    return {
+        "profile": profile,
+        "optimized_for": PROFILES[profile]["optimized_for"],
+        "dims": dims or PROFILES[profile]["dims"] or DEFAULT_DIMS,
+        "partitions": partitions_for(expected_docs),
+    }
+
+
+def settings_from_env():
+    """Return the index settings for CB_INDEX_PROFILE, EMBEDDING_DIMS and CB_EXPECTED_DOCS"""
+    dims = os.getenv("EMBEDDING_DIMS")
+    return index_settings(
+        os.getenv("CB_INDEX_PROFILE", "recall"),
+        int(dims) if dims else None,
+        int(os.getenv("CB_EXPECTED_DOCS", "0")),
+    )
+
+
+def render_index_definition(template, search_index_name, bucket_name, scope_name, collection_name, settings):
+    """Fill in the names of the search index template and apply the profile settings"""
+    content = template.replace("_CB_SEARCHINDEX_", search_index_name)
+    content = content.replace("_CB_BUCKET_", bucket_name)
+    content = content.replace("_CB_SCOPE_", scope_name)
+    content = content.replace("_CB_COLLECTION_", collection_name)
+    definition = json.loads(content)
+
+    definition["planParams"]["indexPartitions"] = settings["partitions"]
+    properties = definition["params"]["mapping"]["types"][f"{scope_name}.{collection_name}"]["properties"]
+    for field in properties["embedding"]["fields"]:
+        field["dims"] = settings["dims"]
+        field["vector_index_optimized_for"] = settings["optimized_for"]
+    return definition
+
+
+def index_url(hostname, bucket_name, scope_name, search_index_name):
+    return f"https://{hostname}:18094/api/bucket/{bucket_name}/scope/{scope_name}/index/{search_index_name}"
+
+
+def put_index_definition(username, password, hostname, bucket_name, scope_name, search_index_name, json_data):
+    """Create or update a scoped search index through the search service REST API"""
+    return requests.put(
+        index_url(hostname, bucket_name, scope_name, search_index_name),
+        headers={"Content-Type": "application/json"},
+        auth=HTTPBasicAuth(username, password),
+        data=json_data,
+        verify=False,  # Use this to skip SSL verification, equivalent to curl's -k option
+    )
+
+
+def delete_index(username, password, hostname, bucket_name, scope_name, search_index_name):
+    """Drop a scoped search index"""
+    return requests.delete(
+        index_url(hostname, bucket_name, scope_name, search_index_name),
+        auth=HTTPBasicAuth(username, password),
+        verify=False,
+    )
+
+
+def indexed_count(username, password, hostname, bucket_name, scope_name, search_index_name):
+    """Return how many documents the search index has indexed so far"""
+    response = requests.get(
+        index_url(hostname, bucket_name, scope_name, search_index_name) + "/count",
+        auth=HTTPBasicAuth(username, password),
+        verify=False,
+    )
+    response.raise_for_status()
+    return response.json()["count"]
@@ -0,0 +1,307 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from itertools import islice
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+import tracing
+from context_assembly import count_tokens
+from documents import document_key, replace_document, touch_chunks
+from tenants import SHARED_TENANT
+
+CHUNK_TOKENS = 350
+CHUNK_OVERLAP_TOKENS = 35
+PAGES_PER_TASK = 8
+EXTRACT_PROCESSES = min(4, os.cpu_count() or 1)
+BATCH_SIZE = 64
+MAX_WORKERS = 4
+
+# Split before heading lines first, numbered ("2.1 Installing") or upper case
+# ("TROUBLESHOOTING"), then at paragraphs, lines, sentences and words
+SEPARATORS = [
+    r"\n(?=(?:\d+(?:\.\d+)*\.?\s+[A-Z][^\n]{0,80}(?<![.,;:])|[A-Z][A-Z0-9 ,&/-]{3,80})\n)",
+    r"\n\s*\n",
+    r"\n",
+    r"(?<=[.!?])\s+",
+    r" ",
+    r"",
+]
+
+
+def get_text_splitter():
+    """Return the text splitter used to chunk PDF pages, measuring chunks in embedding model tokens"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
+        length_function=count_tokens,
+        separators=SEPARATORS,
+        is_separator_regex=True,
+    )
+
+
+def count_pages(file_path):
+    """Return the number of pages in the PDF without extracting any text"""
+    from pypdf import PdfReader
+
+    return len(PdfReader(file_path).pages)
+
+
+def extract_page_range(file_path, start, end):
+    """Extract and split pages [start, end) of the PDF, returning (chunks, extract seconds, split seconds)
+
+    This runs in a worker process, so it opens its own reader and only uses
+    picklable arguments and return values. The chunks carry the same
+    `source` and `page` metadata as PyPDFLoader.
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    text_splitter = get_text_splitter()
+    chunks = []
+    extract_seconds = 0.0
+    split_seconds = 0.0
+    for page in range(start, end):
+        started = time.perf_counter()
+        text = reader.pages[page].extract_text()
+        split_started = time.perf_counter()
+        chunks.extend(text_splitter.create_documents([text], [{"source": file_path, "page": page}]))
+        extract_seconds += split_started - started
+        split_seconds += time.perf_counter() - split_started
+    return chunks, extract_seconds, split_seconds
+
+
+@lru_cache(maxsize=None)
+def get_process_pool(processes):
+    """Return the extraction process pool of this process, started once and reused by every upload
+
+    Workers are spawned rather than forked, forking the threaded web app is
+    not safe.
+    """
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+def iter_pdf_chunks(file_path, total_pages, stats, processes=EXTRACT_PROCESSES, pages_per_task=PAGES_PER_TASK):
+    """Yield the chunks of the PDF in page order as page ranges are extracted and split
+
+    Ranges of `pages_per_task` pages are extracted in `processes` worker
+    processes, at most two per process ahead of the consumer, so embedding
+    starts with the first range while later ones are still being extracted.
+    Small PDFs, or `processes` of 1, are extracted in this process.
+    """
+    ranges = [(start, min(start + pages_per_task, total_pages)) for start in range(0, total_pages, pages_per_task)]
+
+    def finish(start, end, result):
+        chunks, extract_seconds, split_seconds = result
+        stats["pages"] += end - start
+        tracing.count("extract_ms", extract_seconds * 1000)
+        tracing.count("split_ms", split_seconds * 1000)
+        return chunks
+
+    if processes <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield from finish(start, end, extract_page_range(file_path, start, end))
+        return
+
+    pool = get_process_pool(processes)
+    in_flight = deque()
+    try:
+        for start, end in ranges:
+            in_flight.append((start, end, pool.submit(extract_page_range, file_path, start, end)))
+            if len(in_flight) > 2 * processes:
+                start, end, future = in_flight.popleft()
+                yield from finish(start, end, future.result())
+        while in_flight:
+            start, end, future = in_flight.popleft()
+            yield from finish(start, end, future.result())
+    finally:
+        for _, _, future in in_flight:
+            future.cancel()
+
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from the iterable"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def file_hash(file_path):
+    """Return the SHA-256 of the file contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(key, text):
+    """Return the deterministic document ID of a chunk of text from the source document with the `document_key`
+
+    Versions of a document share the IDs of the chunks they have in common,
+    so only the changed chunks are written when a new version is loaded.
+    """
+    return hashlib.sha256((key + "\0" + text).encode("utf-8")).hexdigest()
+
+
+def existing_ids(vector_store, ids):
+    """Return the subset of the IDs that are already stored in the vector store"""
+    if hasattr(vector_store, "existing_ids"):
+        return vector_store.existing_ids(ids)
+
+    result = vector_store._collection.exists_multi(ids)
+    return {id for id, exists_result in result.results.items() if exists_result.exists}
+
+
+def upsert_batch(vector_store, ids, docs, vectors, ttl=None):
+    """Write already embedded chunks to the vector store, expiring after `ttl` seconds, returning how many were written"""
+    with tracing.span("upsert", documents=len(docs)):
+        return _upsert_batch(vector_store, ids, docs, vectors, ttl)
+
+
+def _upsert_batch(vector_store, ids, docs, vectors, ttl):
+    if hasattr(vector_store, "add_embeddings"):
+        vector_store.add_embeddings(
+            [doc.page_content for doc in docs], vectors, [doc.metadata for doc in docs], ids, ttl=ttl
+        )
+        return len(docs)
+
+    # CouchbaseVectorStore only accepts raw texts, so write its document layout directly
+    result = vector_store._collection.upsert_multi(
+        {
+            id: {
+                vector_store._text_key: doc.page_content,
+                vector_store._embedding_key: vector,
+                vector_store._metadata_key: doc.metadata,
+            }
+            for id, doc, vector in zip(ids, docs, vectors)
+        },
+        **({"expiry": timedelta(seconds=ttl)} if ttl else {}),
+    )
+    if not result.all_ok:
+        raise ValueError(f"Failed to upsert documents: {result.exceptions}")
+    return len(docs)
+
+
+def ingest_chunks(
+    chunks, vector_store, stats, source, version=None, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, progress=None, ttl=None, tenant=SHARED_TENANT
+):
+    """Embed the chunks in batches with bounded concurrency and upsert them as each batch is ready
+
+    Chunk IDs are derived from the `tenant`, the `source` document name and
+    the chunk text, and chunks that are already stored are skipped before
+    they are embedded (only their expiry is restarted), so re-ingesting the
+    same file writes nothing. Every chunk is tagged with its `source`,
+    `version` and `tenant`, which retrieval can be prefiltered by, and
+    expires `ttl` seconds after it is written, if set. At most `max_workers`
+    batches are embedding at once and one batch is upserting, so memory
+    stays bounded however many chunks are streamed in.
+    `progress` is called with `stats` from the calling thread after every batch.
+    Returns the IDs of all the chunks of the document.
+    """
+    embedding = vector_store.embeddings
+    key = document_key(source, tenant)
+    seen = set()
+    pending = deque()
+    upserts = deque()
+
+    def finish_upserts(limit):
+        while len(upserts) > limit:
+            stats["chunks"] += upserts.popleft().result()
+            if progress:
+                progress(stats)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as embed_pool, ThreadPoolExecutor(max_workers=1) as upsert_pool:
+
+        def finish_embeddings(limit):
+            while len(pending) > limit:
+                ids, docs, future = pending.popleft()
+                upserts.append(tracing.submit(upsert_pool, upsert_batch, vector_store, ids, docs, future.result(), ttl))
+                finish_upserts(1)
+
+        for batch in batched(chunks, batch_size):
+            new = {}
+            for doc in batch:
+                id = chunk_id(key, doc.page_content)
+                if id not in seen:
+                    seen.add(id)
+                    doc.metadata.update(source=source, version=version, tenant=tenant)
+                    new[id] = doc
+            with tracing.timed("exists_check"):
+                stored = existing_ids(vector_store, list(new)) if new else set()
+            touch_chunks(vector_store, stored, ttl)
+            new = {id: doc for id, doc in new.items() if id not in stored}
+            stats["skipped"] += len(batch) - len(new)
+            if not new:
+                if progress:
+                    progress(stats)
+                continue
+
+            ids, docs = list(new), list(new.values())
+            texts = [doc.page_content for doc in docs]
+            pending.append((ids, docs, tracing.submit(embed_pool, embedding.embed_documents, texts)))
+            finish_embeddings(max_workers - 1)
+
+        finish_embeddings(0)
+        finish_upserts(0)
+
+    return list(seen)
+
+
+def extract_chunks(file_path):
+    """Extract and split a whole PDF, returning (pages, chunks)
+
+    This runs in a worker process when bulk loading, so it extracts in that
+    process and only uses picklable arguments and return values.
+    """
+    stats = {"pages": 0}
+    chunks = list(iter_pdf_chunks(file_path, count_pages(file_path), stats, processes=1))
+    return stats["pages"], chunks
+
+
+def ingest_pdf(
+    file_path, vector_store, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, progress=None, processes=EXTRACT_PROCESSES, source=None, ttl=None, tenant=SHARED_TENANT
+):
+    """Stream the PDF through extraction, splitting, embedding and upsert, returning throughput stats
+
+    The PDF replaces any earlier version of the tenant's `source` document
+    (the file name by default): the chunks only the earlier version had are
+    deleted and counted in `removed`.
+    """
+    source = source or os.path.basename(file_path)
+    version = file_hash(file_path)
+    stats = {
+        "pages": 0,
+        "total_pages": count_pages(file_path),
+        "chunks": 0,
+        "skipped": 0,
+        "start": time.perf_counter(),
+    }
+    chunks = iter_pdf_chunks(file_path, stats["total_pages"], stats, processes=processes)
+    ids = ingest_chunks(
+        chunks,
+        vector_store,
+        stats,
+        source,
+        version,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        progress=progress,
+        ttl=ttl,
+        tenant=tenant,
+    )
+    stats["removed"] = replace_document(vector_store, source, version, ids, stats["pages"], ttl, tenant)
+    return finish_stats(stats)
+
+
+def finish_stats(stats):
+    """Add the elapsed time and pages/s and chunks/s throughput to `stats`"""
+    stats["seconds"] = time.perf_counter() - stats.pop("start")
+    stats["pages_per_s"] = stats["pages"] / stats["seconds"] if stats["seconds"] else 0.0
+    stats["chunks_per_s"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
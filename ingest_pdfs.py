@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from chat_with_pdf import connect_to_couchbase, get_embedding, get_vector_store
+from documents import bump_generation, get_manifest, replace_document
+from ingest import BATCH_SIZE, MAX_WORKERS, extract_chunks, file_hash, finish_stats, ingest_chunks
+from rag_factories import required_environment_variables, use_local_vector_store
+from tenants import SHARED_TENANT
+
+
+def _glob_root(pattern):
+    # The directories of the pattern before its first wildcard
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if any(char in part for char in "*?["):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+
+def find_pdfs(paths):
+    """Expand directories and glob patterns into a sorted list of (PDF file, document name) pairs
+
+    A PDF is named by its path relative to the directory it was found in,
+    or to the directories of the glob pattern before its first wildcard,
+    e.g. `a/manual.pdf` and `b/manual.pdf` of `docs`, so the name doesn't
+    depend on how the directory was given. A PDF found twice is listed once.
+    """
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            root, found = path, glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True)
+        else:
+            root, found = _glob_root(path), glob.glob(path, recursive=True)
+        for file_path in found:
+            source = os.path.relpath(file_path, root).replace(os.sep, "/")
+            files.setdefault(os.path.realpath(file_path), (file_path, source))
+    return sorted(files.values())
+
+
+def name_collisions(pdfs, tenant, loaded_from=None):
+    """Return the document names of the tenant given to more than one PDF, with their files
+
+    `loaded_from` maps the (source, tenant) a previous run loaded to its
+    file, a PDF taking the name of another file replaces that document.
+    """
+    files = {}
+    for file_path, source in pdfs:
+        files.setdefault(source, []).append(file_path)
+    for source, paths in files.items():
+        previous = (loaded_from or {}).get((source, tenant))
+        if previous is not None and previous not in map(os.path.realpath, paths):
+            paths.append(previous)
+    return {source: paths for source, paths in files.items() if len(paths) > 1}
+
+
+def load_checkpoint(checkpoint_path):
+    """Return the (source, tenant, hash) of the files that a previous run finished, and the file of each (source, tenant)"""
+    done = set()
+    loaded_from = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as checkpoint_file:
+            for line in checkpoint_file:
+                if line.strip():
+                    record = json.loads(line)
+                    # Records of older runs without a source and tenant are loaded again
+                    if "source" in record and "tenant" in record:
+                        done.add((record["source"], record["tenant"], record["hash"]))
+                        loaded_from[(record["source"], record["tenant"])] = os.path.realpath(record["file"])
+    return done, loaded_from
+
+
+def is_loaded(vector_store, done, source, tenant, source_hash):
+    """Return True if a previous run finished this version of the document and it is still stored
+
+    A document that was deleted or expired since is loaded again.
+    """
+    if (source, tenant, source_hash) not in done:
+        return False
+    manifest = get_manifest(vector_store, source, tenant)
+    return manifest is not None and manifest["version"] == source_hash
+
+
+def save_checkpoint(checkpoint_file, file_path, source, tenant, source_hash, stats):
+    """Record a finished file, flushed to disk so a crash does not lose it"""
+    checkpoint_file.write(
+        json.dumps({"file": os.path.realpath(file_path), "source": source, "tenant": tenant, "hash": source_hash, "chunks": stats["chunks"]}) + "\n"
+    )
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load a directory or glob of PDFs into the Couchbase vector store")
+    parser.add_argument("paths", nargs="+", help="PDF files, directories or glob patterns")
+    parser.add_argument("--checkpoint", default="ingest_checkpoint.jsonl", help="file recording finished PDFs")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="text extraction processes")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="chunks per embedding batch")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS, help="embedding batches in flight")
+    parser.add_argument("--ttl", type=int, default=0, help="seconds until the loaded documents expire, 0 keeps them")
+    parser.add_argument("--tenant", default=SHARED_TENANT, help="tenant that may retrieve the documents, by default everyone")
+    parser.add_argument(
+        "--allow-replace", action="store_true", help="let PDFs replace the documents of the same name a previous run loaded from other files"
+    )
+    args = parser.parse_args()
+
+    for variable_name in required_environment_variables():
+        if variable_name not in os.environ:
+            print(f"{variable_name} environment variable is not set. Please add it to the _setup file")
+            sys.exit(1)
+
+    cluster = None
+    if not use_local_vector_store():
+        cluster = connect_to_couchbase(os.getenv("CB_HOSTNAME"), os.getenv("CB_USERNAME"), os.getenv("CB_PASSWORD"))
+    embedding = get_embedding(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite"))
+    vector_store = get_vector_store(
+        cluster,
+        os.getenv("CB_BUCKET"),
+        os.getenv("CB_SCOPE"),
+        os.getenv("CB_COLLECTION"),
+        embedding,
+        os.getenv("CB_SEARCHINDEX"),
+    )
+
+    done, loaded_from = load_checkpoint(args.checkpoint)
+    todo = []
+    pdfs = find_pdfs(args.paths)
+    # Two PDFs with the same name would replace each other, so nothing is loaded
+    collisions = name_collisions(pdfs, args.tenant, None if args.allow_replace else loaded_from)
+    if collisions:
+        for source, paths in sorted(collisions.items()):
+            print(f"'{source}' would name several PDFs: {', '.join(paths)}")
+        print("Give their common parent directory, so their names differ, or --allow-replace for new files of loaded documents.")
+        sys.exit(1)
+    for file_path, source in pdfs:
+        source_hash = file_hash(file_path)
+        if is_loaded(vector_store, done, source, args.tenant, source_hash):
+            print(f"Skipping '{file_path}', already loaded.")
+        else:
+            todo.append((file_path, source, source_hash))
+    print(f"Loading {len(todo)} PDF(s).")
+
+    totals = {"files": 0, "failed": 0, "pages": 0, "chunks": 0, "skipped": 0, "removed": 0, "start": time.perf_counter()}
+    with open(args.checkpoint, "a") as checkpoint_file, ProcessPoolExecutor(max_workers=args.processes) as pool:
+        extracting = deque()
+
+        def finish_file():
+            file_path, source, source_hash, future = extracting.popleft()
+            try:
+                pages, chunks = future.result()
+                stats = {"pages": pages, "chunks": 0, "skipped": 0, "start": time.perf_counter()}
+                # A changed file replaces the previous version of the document with its name
+                ids = ingest_chunks(
+                    chunks,
+                    vector_store,
+                    stats,
+                    source,
+                    source_hash,
+                    batch_size=args.batch_size,
+                    max_workers=args.max_workers,
+                    ttl=args.ttl,
+                    tenant=args.tenant,
+                )
+                stats["removed"] = replace_document(vector_store, source, source_hash, ids, pages, args.ttl, args.tenant)
+                if stats["chunks"] or stats["removed"]:
+                    # Running apps drop their cached searches as soon as each document is in
+                    bump_generation(vector_store)
+                finish_stats(stats)
+            except Exception as e:
+                totals["failed"] += 1
+                print(f"Failed to load '{file_path}': {e}")
+                return
+            save_checkpoint(checkpoint_file, file_path, source, args.tenant, source_hash, stats)
+            for key in ["pages", "chunks", "skipped", "removed"]:
+                totals[key] += stats[key]
+            totals["files"] += 1
+            print(
+                f"[{totals['files'] + totals['failed']}/{len(todo)}] '{file_path}': {stats['pages']} pages, "
+                f"{stats['chunks']} documents stored, {stats['skipped']} already present, "
+                f"{stats['removed']} from a previous version removed ({stats['chunks_per_s']:.1f} documents/s)"
+            )
+
+        # Keep a bounded number of files extracting ahead of the embedding and upsert stage
+        for file_path, source, source_hash in todo:
+            extracting.append((file_path, source, source_hash, pool.submit(extract_chunks, file_path)))
+            if len(extracting) > 2 * args.processes:
+                finish_file()
+        while extracting:
+            finish_file()
+
+    finish_stats(totals)
+    print(
+        f"Loaded {totals['files']} PDF(s), {totals['failed']} failed: {totals['pages']} pages, "
+        f"{totals['chunks']} documents in {totals['seconds']:.1f}s "
+        f"({totals['pages_per_s']:.1f} pages/s, {totals['chunks_per_s']:.1f} documents/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from async_retrieval import AsyncCouchbaseRetriever, AsyncSearchClient
+from benchmark import percentiles, sample_questions
+from fakes import FakeAsyncSearchClient, HashingEmbeddings, sample_page_text
+from local_vector_store import LocalVectorStore
+
+
+def run_sessions(retriever, questions, sessions, queries_per_session):
+    """Run `sessions` threads that each retrieve `queries_per_session` questions back to back"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def session(offset):
+        for i in range(queries_per_session):
+            question, _ = questions[(offset + i) % len(questions)]
+            start = time.perf_counter()
+            try:
+                retriever.invoke(question)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=session, args=(n * queries_per_session,)) for n in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    return {
+        "sessions": sessions,
+        "queries": len(latencies),
+        "errors": len(errors),
+        "qps": len(latencies) / seconds,
+        "latency_ms": percentiles(latencies) if latencies else None,
+    }
+
+
+def fake_client(work_dir, args):
+    """Return a simulated search client over a local store of `args.pages` sample pages"""
+    embedding = HashingEmbeddings()
+    store = LocalVectorStore(embedding, path=os.path.join(work_dir, "store"))
+    store.add_texts(["\n".join(sample_page_text(page)) for page in range(args.pages)])
+    client = FakeAsyncSearchClient(
+        store, latency=args.search_latency, max_concurrency=args.max_concurrency, timeout=args.timeout
+    )
+    return client, embedding
+
+
+def couchbase_client(args):
+    """Return a search client connected to the cluster configured by the CB_* variables"""
+    from couchbase.auth import PasswordAuthenticator
+    from langchain_openai import OpenAIEmbeddings
+
+    client = AsyncSearchClient(
+        "couchbases://" + os.environ["CB_HOSTNAME"] + "/?ssl=no_verify",
+        PasswordAuthenticator(os.environ["CB_USERNAME"], os.environ["CB_PASSWORD"]),
+        os.environ["CB_BUCKET"],
+        os.environ["CB_SCOPE"],
+        os.environ["CB_SEARCHINDEX"],
+        max_concurrency=args.max_concurrency,
+        timeout=args.timeout,
+    )
+    return client, OpenAIEmbeddings()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how retrieval throughput scales with concurrent sessions")
+    parser.add_argument("--backend", choices=["fake", "couchbase"], default="fake", help="simulated search or the CB_* cluster")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="concurrent session counts")
+    parser.add_argument("--queries-per-session", type=int, default=20, help="questions each session asks in turn")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="searches in flight at once")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds per search attempt")
+    parser.add_argument("--k", type=int, default=4, help="documents retrieved per question")
+    parser.add_argument("--pages", type=int, default=200, help="sample pages in the fake backend's store")
+    parser.add_argument("--search-latency", type=float, default=0.02, help="seconds per fake search round trip")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        client, embedding = fake_client(work_dir, args) if args.backend == "fake" else couchbase_client(args)
+        retriever = AsyncCouchbaseRetriever(client=client, embedding=embedding, k=args.k)
+        questions = sample_questions(args.pages, 200)
+        results = [run_sessions(retriever, questions, sessions, args.queries_per_session) for sessions in args.sessions]
+
+    report = json.dumps({"config": vars(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
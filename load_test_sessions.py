@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+from benchmark import percentiles, sample_questions
+from embedding_batcher import BatchingEmbeddings
+from embedding_cache import CachedEmbeddings
+from fakes import FakeStreamingChatModel, HashingEmbeddings, NullAnswerCache, sample_page_text
+from tenants import SHARED_TENANT
+
+
+def load_workload(path):
+    """Return the requests of a JSON lines workload, each {"question": ..., "modes": [...], "tenant": ...}
+
+    Only `question` is required, lines without one are skipped.
+    """
+    workload = []
+    with open(path, "r") as workload_file:
+        for line in workload_file:
+            if line.strip():
+                request = json.loads(line)
+                if request.get("question"):
+                    workload.append(request)
+    if not workload:
+        raise ValueError(f"No questions in the workload '{path}'")
+    return workload
+
+
+class ChainTarget:
+    """Answers in process through the API's answer path, with offline stand-ins for OpenAI and Couchbase
+
+    The sample corpus is loaded into a local vector store and searched with
+    the configured RETRIEVER_MODE, embeddings are hashed and answers come
+    from a fake streaming chat model, each with the given latencies.
+    Concurrent embedding calls are batched like the app does, unless the
+    batch wait is 0. The answer cache is off unless `answer_cache` is set,
+    and the retrieval cache, with the embedding cache in front of it as in
+    the app, unless `retrieval_cache` is set.
+    """
+
+    def __init__(self, work_dir, args):
+        from api_server import answer_events
+        from local_vector_store import LocalVectorStore
+        from rag_factories import build_pure_chain, build_rag_chain, make_answer_cache, make_assemble
+
+        os.environ["VECTOR_STORE"] = "local"
+        if not args.retrieval_cache:
+            os.environ["RETRIEVAL_CACHE_MB"] = "0"
+        self.answer_events = answer_events
+        self.embedding_api = HashingEmbeddings(latency=args.embedding_latency)
+        embedding = self.embedding_api
+        if args.batch_wait_ms > 0:
+            embedding = BatchingEmbeddings(embedding, max_batch=args.max_batch, max_wait=args.batch_wait_ms / 1000)
+        if args.retrieval_cache:
+            embedding = CachedEmbeddings(embedding, path=os.path.join(work_dir, "embedding_cache.sqlite"))
+        vector_store = LocalVectorStore(embedding, path=os.path.join(work_dir, "store"))
+        vector_store.add_texts(
+            ["\n".join(sample_page_text(page)) for page in range(args.pages)],
+            [{"source": "sample.pdf", "page": page, "tenant": SHARED_TENANT} for page in range(args.pages)],
+        )
+
+        def llm():
+            return FakeStreamingChatModel(first_token_latency=args.first_token_latency, token_latency=args.token_latency)
+
+        self.components = {
+            "embedding": embedding,
+            "vector_store": vector_store,
+            "search_client": None,
+            "answer_cache": make_answer_cache(embedding, vector_store) if args.answer_cache else NullAnswerCache(),
+            "assemble": make_assemble(embedding),
+            "chain": build_rag_chain(llm()),
+            "chain_without_rag": build_pure_chain(llm()),
+        }
+
+    def ask(self, request, modes):
+        """Answer one request, returning the seconds to the first token"""
+        start = time.perf_counter()
+        first_token = None
+        for event, _ in self.answer_events(self.components, request["question"], modes, request.get("tenant")):
+            if event == "token" and first_token is None:
+                first_token = time.perf_counter() - start
+        return first_token
+
+    def close(self):
+        pass
+
+
+class HttpTarget:
+    """Answers through POST /ask of a running api_server, sending API_TOKEN as the bearer token"""
+
+    def __init__(self, url, max_connections, timeout):
+        import httpx
+
+        self.url = url.rstrip("/") + "/ask"
+        self.client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout),
+        )
+        self.headers = {"Authorization": "Bearer " + os.environ["API_TOKEN"]} if os.getenv("API_TOKEN") else {}
+
+    def ask(self, request, modes):
+        """Stream one answer, returning the seconds to the first token event"""
+        headers = dict(self.headers)
+        if request.get("tenant"):
+            headers["X-Tenant"] = request["tenant"]
+        start = time.perf_counter()
+        first_token = None
+        with self.client.stream("POST", self.url, json={"question": request["question"], "modes": modes}, headers=headers) as response:
+            if response.status_code != 200:
+                raise ValueError(f"HTTP {response.status_code}: {response.read().decode('utf-8', 'replace')}")
+            event = None
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: ") :]
+                elif line.startswith("data: "):
+                    if event == "token" and first_token is None:
+                        first_token = time.perf_counter() - start
+                    elif event == "error":
+                        raise ValueError(json.loads(line[len("data: ") :])["error"])
+        return first_token
+
+    def close(self):
+        self.client.close()
+
+
+def run_level(target, workload, args, concurrency, rate):
+    """Send `args.requests` requests with at most `concurrency` in flight, returning the level's stats
+
+    Without a `rate` each of the `concurrency` sessions asks its next
+    question `args.think_time` seconds after its previous answer (a closed
+    loop). With a `rate` requests arrive at random at `rate` per second
+    whatever the response times (an open loop), so the latency includes the
+    time a request waits for a free session once the deployment saturates.
+    """
+    latencies = []
+    first_tokens = []
+    errors = []
+    lock = threading.Lock()
+    rng = random.Random(args.seed)
+    requests = [workload[i % len(workload)] for i in range(args.requests)]
+
+    def send(request, arrival):
+        try:
+            first_token = target.ask(request, request.get("modes") or args.modes)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - arrival)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+    def session(offset):
+        for request in requests[offset::concurrency]:
+            send(request, time.perf_counter())
+            time.sleep(args.think_time)
+
+    embedding_calls = target.embedding_api.calls if isinstance(target, ChainTarget) else 0
+    started = time.time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate:
+            arrival = start
+            for request in requests:
+                arrival += rng.expovariate(rate)
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+                pool.submit(send, request, arrival)
+        else:
+            for offset in range(min(concurrency, len(requests))):
+                pool.submit(session, offset)
+    seconds = time.perf_counter() - start
+
+    level = {
+        "concurrency": concurrency,
+        "rate": rate,
+        "requests": len(requests),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(requests),
+        "throughput_rps": len(latencies) / seconds,
+        "latency_ms": percentiles(latencies) if latencies else None,
+        "first_token_ms": percentiles(first_tokens) if first_tokens else None,
+    }
+    if errors:
+        level["first_error"] = errors[0]
+    if isinstance(target, ChainTarget):
+        level["embedding_calls"] = target.embedding_api.calls - embedding_calls
+        # Where the time went, from the traces of the level's requests
+        traces = [t for t in tracing.recent_traces if t.name == "question" and t.started >= started]
+        level["stages_ms"] = {
+            name: {"p50": values["p50"], "p95": values["p95"]}
+            for name, values in tracing.summarize(traces)["spans"].items()
+        }
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how chat latency, throughput and errors change with concurrent sessions")
+    parser.add_argument("--target", choices=["chain", "http"], default="chain", help="in-process chains with stand-ins, or a running api_server")
+    parser.add_argument("--url", default="http://localhost:8000", help="api_server base URL for --target http")
+    parser.add_argument("--workload", help="JSON lines file of questions to replay, default generated sample questions")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="sessions in flight")
+    parser.add_argument("--rates", type=float, nargs="+", help="open loop arrival rates in requests/s, default closed loop sessions")
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency and rate")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a closed loop session waits between questions")
+    parser.add_argument("--modes", nargs="+", choices=["pure", "rag"], default=["pure", "rag"], help="answers per question")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds per HTTP request")
+    parser.add_argument("--pages", type=int, default=200, help="sample pages in the stand-in vector store")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per fake embedding call")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="seconds to the fake LLM's first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between fake LLM tokens")
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0, help="milliseconds concurrent embedding calls are collected, 0 sends each alone")
+    parser.add_argument("--max-batch", type=int, default=256, help="texts per batched embedding call")
+    parser.add_argument("--answer-cache", action="store_true", help="answer repeated questions from the answer cache")
+    parser.add_argument("--retrieval-cache", action="store_true", help="answer repeated searches from the retrieval and embedding caches")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the sample questions and arrival times")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if args.workload:
+        workload = load_workload(args.workload)
+    else:
+        workload = [{"question": question} for question, _ in sample_questions(args.pages, 200, args.seed)]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.target == "chain":
+            target = ChainTarget(work_dir, args)
+        else:
+            target = HttpTarget(args.url, max(args.concurrency), args.timeout)
+        try:
+            results = [
+                run_level(target, workload, args, concurrency, rate)
+                for concurrency in args.concurrency
+                for rate in args.rates or [None]
+            ]
+        finally:
+            target.close()
+
+    report = json.dumps({"config": vars(args), "workload": len(workload), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
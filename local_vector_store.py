@@ -0,0 +1,325 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+import tracing
+
+DIMS = 1536
+BLOCK_ROWS = 65536
+MIN_CAPACITY = 1024
+
+
+class _Column:
+    """Growable 1-D array, its capacity doubles when full so appends are amortized O(1)"""
+
+    def __init__(self, values, dtype):
+        values = np.asarray(values, dtype=dtype)
+        self.size = len(values)
+        self.data = np.empty(max(self.size, 16), dtype=dtype)
+        self.data[: self.size] = values
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        if self.size + len(values) > len(self.data):
+            data = np.empty(max(2 * len(self.data), self.size + len(values)), dtype=self.data.dtype)
+            data[: self.size] = self.data[: self.size]
+            self.data = data
+        self.data[self.size : self.size + len(values)] = values
+        self.size += len(values)
+
+    def view(self):
+        return self.data[: self.size]
+
+
+class LocalVectorStore(VectorStore):
+    """In-process vector store kept in a directory on local disk
+
+    The vectors are appended to a float32 file that is memory mapped for
+    search, and the texts and metadata are appended to a JSON lines file,
+    along with deletes and expiry changes. The file and its mapping grow by
+    doubling, and the live, expiry and tenant indexes are appended to, so
+    appends cost the same however large the store is. Searches read one
+    snapshot of the matrix and indexes that appends replace as a whole. Documents written or touched with
+    a `ttl` are left out of searches once it has passed. The manifests of
+    the source documents are kept in a JSON file.
+    Search is a batched dot product top-k over the matrix, or only over the
+    rows of the `tenants` whose metadata is searched for, matching the
+    `dot_product` similarity and 1536 dims of the Couchbase search index, so
+    the whole ingest and query flow can run offline and be compared with it.
+    """
+
+    def __init__(self, embedding, path="local_vector_store", dims=DIMS):
+        os.makedirs(path, exist_ok=True)
+        self._embedding = embedding
+        self.dims = dims
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._docs_path = os.path.join(path, "docs.jsonl")
+        self._manifests_path = os.path.join(path, "manifests.json")
+        self._lock = threading.Lock()
+        self._texts = []
+        self._metadatas = []
+        self._row_ids = []
+        self._rows = {}
+        self._manifests = {}
+        self.generation = 0
+
+        expiry = []
+        if os.path.exists(self._docs_path):
+            for record in self._read_docs():
+                if record.get("deleted"):
+                    self._rows.pop(record["id"], None)
+                elif "text" not in record:
+                    if record["id"] in self._rows:
+                        expiry[self._rows[record["id"]]] = record["expires_at"]
+                else:
+                    self._append_row(record["id"], record["text"], record["metadata"])
+                    expiry.append(record.get("expires_at"))
+        if os.path.exists(self._manifests_path):
+            with open(self._manifests_path, "r") as manifests_file:
+                self._manifests = json.load(manifests_file)
+        self._open_matrix(expiry)
+
+    def _read_docs(self):
+        """Return the records of the docs file, truncating a last line torn by a crash mid-write"""
+        records = []
+        offset = 0
+        with open(self._docs_path, "rb") as docs_file:
+            for line in docs_file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                offset += len(line)
+        if offset < os.path.getsize(self._docs_path):
+            os.truncate(self._docs_path, offset)
+        return records
+
+    def _append_row(self, id, text, metadata):
+        self._rows[id] = len(self._texts)
+        self._row_ids.append(id)
+        self._texts.append(text)
+        self._metadatas.append(metadata)
+
+    def _open_matrix(self, expiry):
+        rows = os.path.getsize(self._vectors_path) // (4 * self.dims) if os.path.exists(self._vectors_path) else 0
+        # A crash between the two appends can leave one file a row ahead of the other. The
+        # vectors without a document are cut off, or the next append would be written after them
+        rows = min(rows, len(self._texts))
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) > rows * 4 * self.dims:
+            os.truncate(self._vectors_path, rows * 4 * self.dims)
+        del self._texts[rows:], self._metadatas[rows:], self._row_ids[rows:], expiry[rows:]
+        self._rows = {id: row for id, row in self._rows.items() if row < rows}
+        live = np.zeros(rows, dtype=bool)
+        live[list(self._rows.values())] = True
+        self._live = _Column(live, bool)
+        self._expires = _Column([np.inf if e is None else e for e in expiry], np.float64)
+        tenant_rows = {}
+        for row, metadata in enumerate(self._metadatas):
+            tenant_rows.setdefault(metadata.get("tenant"), []).append(row)
+        self._tenant_rows = {tenant: _Column(rows, np.int64) for tenant, rows in tenant_rows.items()}
+        self._map(max(rows, MIN_CAPACITY))
+        self._publish({tenant: column.view() for tenant, column in self._tenant_rows.items()})
+
+    def _map(self, capacity):
+        """Pad the vectors file with zero rows up to `capacity` rows and memory map all of them"""
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size < capacity * 4 * self.dims:
+            with open(self._vectors_path, "ab") as vectors_file:
+                vectors_file.truncate(capacity * 4 * self.dims)
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(capacity, self.dims))
+
+    def _publish(self, tenant_rows):
+        # Searches read this tuple once, so they see the matrix and indexes of one point in time
+        rows = len(self._texts)
+        self._snapshot = (self._matrix[:rows], self._live.view(), self._expires.view(), tenant_rows)
+
+    @property
+    def embeddings(self):
+        """Return the query embedding object."""
+        return self._embedding
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None, ttl=None):
+        """Append already embedded texts, replacing any earlier document with the same ID"""
+        texts = list(texts)
+        expires_at = time.time() + ttl if ttl else None
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if ids is None:
+            ids = [uuid.uuid4().hex for _ in texts]
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(texts), self.dims)
+
+        with self._lock:
+            start = len(self._texts)
+            if start + len(texts) > len(self._matrix):
+                self._map(max(2 * len(self._matrix), start + len(texts)))
+            # Written after the last row, the file past it is padding up to the capacity
+            with open(self._vectors_path, "r+b") as vectors_file:
+                vectors_file.seek(start * 4 * self.dims)
+                vectors_file.write(vectors.tobytes())
+            new_tenant_rows = {}
+            with open(self._docs_path, "a") as docs_file:
+                for row, (id, text, metadata) in enumerate(zip(ids, texts, metadatas), start):
+                    docs_file.write(
+                        json.dumps({"id": id, "text": text, "metadata": metadata, "expires_at": expires_at}) + "\n"
+                    )
+                    if id in self._rows:
+                        # The earlier version of a replaced document is no longer searched
+                        self._live.data[self._rows[id]] = False
+                    self._append_row(id, text, metadata)
+                    new_tenant_rows.setdefault(metadata.get("tenant"), []).append(row)
+            self._live.append(np.ones(len(texts), dtype=bool))
+            self._expires.append(np.full(len(texts), np.inf if expires_at is None else expires_at))
+            tenant_rows = dict(self._snapshot[3])
+            for tenant, rows in new_tenant_rows.items():
+                if tenant in self._tenant_rows:
+                    self._tenant_rows[tenant].append(rows)
+                else:
+                    self._tenant_rows[tenant] = _Column(rows, np.int64)
+                tenant_rows[tenant] = self._tenant_rows[tenant].view()
+            self._publish(tenant_rows)
+        return list(ids)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embed the texts and append them to the store"""
+        texts = list(texts)
+        return self.add_embeddings(texts, self._embedding.embed_documents(texts), metadatas, ids)
+
+    def existing_ids(self, ids):
+        """Return the subset of the IDs that are stored and not expired"""
+        now = time.time()
+        with self._lock:
+            return {id for id in ids if id in self._rows and self._expires.data[self._rows[id]] > now}
+
+    def touch(self, ids, ttl):
+        """Restart the expiry of the stored documents with the given IDs"""
+        expires_at = time.time() + ttl
+        with self._lock:
+            with open(self._docs_path, "a") as docs_file:
+                for id in ids:
+                    row = self._rows.get(id)
+                    if row is not None:
+                        self._expires.data[row] = expires_at
+                        docs_file.write(json.dumps({"id": id, "expires_at": expires_at}) + "\n")
+
+    def _save_manifests(self):
+        temp_path = self._manifests_path + ".tmp"
+        with open(temp_path, "w") as manifests_file:
+            json.dump(self._manifests, manifests_file)
+        os.replace(temp_path, self._manifests_path)
+
+    def get_manifest(self, id):
+        """Return the manifest with the given ID, or None"""
+        return self._manifests.get(id)
+
+    def put_manifest(self, id, manifest):
+        """Store the manifest of a source document under the given ID"""
+        with self._lock:
+            self._manifests[id] = manifest
+            self._save_manifests()
+
+    def delete_manifest(self, id):
+        """Drop the manifest with the given ID"""
+        with self._lock:
+            if self._manifests.pop(id, None) is not None:
+                self._save_manifests()
+
+    def manifests(self):
+        """Return the manifests of all source documents by ID"""
+        with self._lock:
+            return dict(self._manifests)
+
+    def bump_generation(self):
+        """Increment the generation counter of the documents, returning the new value"""
+        with self._lock:
+            self.generation += 1
+            return self.generation
+
+    def delete(self, ids=None, **kwargs):
+        """Delete the documents with the given IDs"""
+        if ids is None:
+            raise ValueError("No document ids provided to delete.")
+        with self._lock:
+            with open(self._docs_path, "a") as docs_file:
+                for id in ids:
+                    row = self._rows.pop(id, None)
+                    if row is not None:
+                        self._live.data[row] = False
+                        docs_file.write(json.dumps({"id": id, "deleted": True}) + "\n")
+        return True
+
+    def search_by_vectors(self, queries, k=4, tenants=None):
+        """Return the top-k (row, score) pairs for each query vector, scoring the matrix block by block
+
+        With `tenants` only the rows of those tenants are scored.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dims)
+        matrix, live, expires, tenant_rows = self._snapshot
+        live = live & (expires > time.time())
+        candidates = None
+        if tenants is not None:
+            empty = np.zeros(0, dtype=np.int64)
+            candidates = np.sort(np.concatenate([empty] + [tenant_rows.get(tenant, empty) for tenant in tenants]))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(matrix) if candidates is None else len(candidates), BLOCK_ROWS):
+            if candidates is None:
+                block_rows = np.arange(start, min(start + BLOCK_ROWS, len(matrix)))
+                scores = queries @ matrix[start : start + BLOCK_ROWS].T
+            else:
+                block_rows = candidates[start : start + BLOCK_ROWS]
+                scores = queries @ matrix[block_rows].T
+            scores[:, ~live[block_rows]] = -np.inf
+            rows = np.broadcast_to(block_rows, scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        results = []
+        for scores, rows in zip(np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)):
+            results.append([(int(row), float(score)) for row, score in zip(rows, scores) if score > -np.inf])
+        return results
+
+    def _to_document(self, row):
+        return Document(id=self._row_ids[row], page_content=self._texts[row], metadata=dict(self._metadatas[row]))
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, tenants=None, **kwargs):
+        """Return docs most similar to embedding vector with their scores, only of `tenants` if given"""
+        with tracing.span("vector_search"):
+            results = self.search_by_vectors([embedding], k, tenants)[0]
+        return [(self._to_document(row), score) for row, score in results]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        """Return docs most similar to embedding vector"""
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        """Return documents that are most similar to the query with their scores"""
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        """Return documents most similar to the query"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        """Create a local vector store from raw texts"""
+        ids = kwargs.pop("ids", None)
+        vector_store = cls(embedding, **kwargs)
+        vector_store.add_texts(texts, metadatas, ids)
+        return vector_store
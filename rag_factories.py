@@ -0,0 +1,346 @@
+import os
+import tempfile
+from functools import lru_cache, partial
+
+import httpx
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnablePassthrough
+from langchain_couchbase import CouchbaseVectorStore
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+import tracing
+from answer_cache import AnswerCache
+from async_retrieval import AsyncCouchbaseRetriever, AsyncSearchClient
+from context_assembly import TOKEN_BUDGET, assemble_context
+from documents import GenerationCounter, bump_generation, delete_document
+from embedding_batcher import BatchingEmbeddings
+from embedding_cache import CachedEmbeddings
+from hybrid_retriever import HybridRetriever, VectorRetriever
+from index_profiles import DEFAULT_DIMS
+from ingest import ingest_pdf
+from local_vector_store import LocalVectorStore
+from retrieval_cache import CachedRetriever, RetrievalCache
+from tenants import SHARED_TENANT
+
+LLM_MODEL = "gpt-4-1106-preview"
+COUCHBASE_VARIABLES = ["CB_HOSTNAME", "CB_USERNAME", "CB_PASSWORD", "CB_BUCKET", "CB_SCOPE", "CB_COLLECTION", "CB_SEARCHINDEX"]
+
+
+def use_local_vector_store():
+    """Return True when VECTOR_STORE=local replaces Couchbase"""
+    return os.getenv("VECTOR_STORE") == "local"
+
+
+def required_environment_variables():
+    """Return the environment variables the app needs in the configured mode"""
+    return ["OPENAI_API_KEY"] + ([] if use_local_vector_store() else COUCHBASE_VARIABLES)
+
+
+def connect_to_couchbase(connection_string, db_username, db_password):
+    """Connect to couchbase"""
+    from couchbase.cluster import Cluster
+    from couchbase.auth import PasswordAuthenticator
+    from couchbase.options import ClusterOptions
+    from datetime import timedelta
+
+    auth = PasswordAuthenticator(db_username, db_password)
+    options = ClusterOptions(auth)
+    connect_string = "couchbases://" + connection_string + "/?ssl=no_verify"
+    cluster = Cluster(connect_string, options)
+
+    # Wait until the cluster is ready for use.
+    cluster.wait_until_ready(timedelta(seconds=5))
+
+    return cluster
+
+
+def make_async_search_client(connection_string, db_username, db_password, db_bucket, db_scope, index_name, max_concurrency, timeout, retries):
+    """Return an async search client with its own connection to the cluster"""
+    from couchbase.auth import PasswordAuthenticator
+
+    return AsyncSearchClient(
+        "couchbases://" + connection_string + "/?ssl=no_verify",
+        PasswordAuthenticator(db_username, db_password),
+        db_bucket,
+        db_scope,
+        index_name,
+        max_concurrency=max_concurrency,
+        timeout=timeout,
+        retries=retries,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_http_client():
+    """Return the HTTP client shared by the OpenAI embeddings and chat models of this process
+
+    One keep-alive pool of OPENAI_MAX_CONNECTIONS connections saves the TLS
+    handshakes a new client per model (or per rerun) would pay for.
+    """
+    max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
+
+def embedding_dims():
+    """Return the embedding size, EMBEDDING_DIMS truncates text-embedding-3 vectors to match a smaller index"""
+    return int(os.getenv("EMBEDDING_DIMS", str(DEFAULT_DIMS)))
+
+
+def make_embedding(cache_path):
+    """Return the OpenAI embeddings wrapped in the persistent embedding cache
+
+    The cache misses of concurrent questions and uploads are sent to OpenAI
+    in batches of up to EMBEDDING_MAX_BATCH texts, collected for
+    EMBEDDING_BATCH_WAIT_MS milliseconds. EMBEDDING_BATCH_WAIT_MS=0 sends
+    every request on its own.
+    """
+    kwargs = {"model": os.getenv("EMBEDDING_MODEL")} if os.getenv("EMBEDDING_MODEL") else {}
+    if os.getenv("EMBEDDING_DIMS"):
+        kwargs["dimensions"] = embedding_dims()
+    embedding = OpenAIEmbeddings(http_client=get_http_client(), **kwargs)
+    batch_wait_ms = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+    if batch_wait_ms > 0:
+        embedding = BatchingEmbeddings(
+            embedding, max_batch=int(os.getenv("EMBEDDING_MAX_BATCH", "256")), max_wait=batch_wait_ms / 1000
+        )
+    return CachedEmbeddings(embedding, path=cache_path)
+
+
+def make_vector_store(cluster, db_bucket, db_scope, db_collection, embedding, index_name):
+    """Return the Couchbase vector store, or the local one when VECTOR_STORE=local"""
+    if use_local_vector_store():
+        return LocalVectorStore(
+            embedding, path=os.getenv("LOCAL_VECTOR_STORE_PATH", "local_vector_store"), dims=embedding_dims()
+        )
+
+    return CouchbaseVectorStore(
+        cluster=cluster,
+        bucket_name=db_bucket,
+        scope_name=db_scope,
+        collection_name=db_collection,
+        embedding=embedding,
+        index_name=index_name,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_generation_counter(vector_store):
+    """Return the reader of the vector store's generation counter, re-read at most every GENERATION_CHECK_SECONDS"""
+    return GenerationCounter(vector_store, check_interval=float(os.getenv("GENERATION_CHECK_SECONDS", "1")))
+
+
+def make_answer_cache(embedding, vector_store):
+    """Return the answer cache configured by ANSWER_CACHE_THRESHOLD and ANSWER_CACHE_TTL
+
+    Its RAG answers are dropped once documents are added to or removed from
+    the vector store.
+    """
+    return AnswerCache(
+        embedding,
+        get_generation_counter(vector_store),
+        threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.98")),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_retrieval_cache(vector_store):
+    """Return the retrieval cache of the vector store, or None when RETRIEVAL_CACHE_MB=0
+
+    It holds up to RETRIEVAL_CACHE_MB megabytes of search results for
+    RETRIEVAL_CACHE_TTL seconds, and drops them all once the store's
+    generation counter shows documents were added or removed.
+    """
+    max_mb = float(os.getenv("RETRIEVAL_CACHE_MB", "64"))
+    if max_mb <= 0:
+        return None
+    return RetrievalCache(
+        get_generation_counter(vector_store),
+        max_bytes=int(max_mb * 1024 * 1024),
+        ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", "600")),
+    )
+
+
+def make_retriever(vector_store, embedding, search_client=None, tenants=None):
+    """Return the retriever selected by RETRIEVER_MODE, fetching RAG_TOP_K chunks of `tenants` (default all)
+
+    A few more chunks are fetched than fit in the prompt so the context
+    assembly can pick the best. RETRIEVER_MODE=hybrid also matches the
+    question text against the indexed `text` field and RETRIEVER_MODE=async
+    sends the searches through `search_client`. Both need Couchbase.
+    The tenant filter is part of the search request, so only the tenants'
+    chunks are searched. Repeated searches are answered from the
+    retrieval cache, if enabled.
+    """
+    rag_top_k = int(os.getenv("RAG_TOP_K", "8"))
+    retriever = _make_retriever(vector_store, embedding, search_client, tenants, rag_top_k)
+    cache = get_retrieval_cache(vector_store)
+    if cache is None:
+        return retriever
+    return CachedRetriever(
+        retriever=retriever,
+        embedding=embedding,
+        cache=cache,
+        k=rag_top_k,
+        tenants=tenants,
+        # The hybrid search also matches the text, so the same vector doesn't mean the same results
+        key_on_text=isinstance(retriever, HybridRetriever),
+    )
+
+
+def _make_retriever(vector_store, embedding, search_client, tenants, rag_top_k):
+    retriever_mode = os.getenv("RETRIEVER_MODE", "vector")
+    if use_local_vector_store():
+        return vector_store.as_retriever(search_kwargs={"k": rag_top_k, "tenants": tenants})
+    if retriever_mode == "hybrid":
+        return HybridRetriever(
+            vector_store=vector_store,
+            k=rag_top_k,
+            tenants=tenants,
+            text_weight=float(os.getenv("HYBRID_TEXT_WEIGHT", "0.3")),
+            vector_weight=float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0")),
+        )
+    if retriever_mode == "async" and search_client is not None:
+        return AsyncCouchbaseRetriever(client=search_client, embedding=embedding, k=rag_top_k, tenants=tenants)
+    return VectorRetriever(vector_store=vector_store, k=rag_top_k, tenants=tenants)
+
+
+def make_assemble(embedding):
+    """Return the function that reranks, de-overlaps and packs the retrieved chunks into CONTEXT_TOKEN_BUDGET tokens"""
+    return partial(
+        assemble_context,
+        embedding=embedding,
+        token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", str(TOKEN_BUDGET))),
+    )
+
+
+def make_llm(**kwargs):
+    """Return the OpenAI GPT 4 chat model used for both answers"""
+    return ChatOpenAI(model=LLM_MODEL, http_client=get_http_client(), **kwargs)
+
+
+def build_rag_chain(llm):
+    """Return the RAG chain, the context is retrieved once up front and passed in with the question"""
+    template = """You are a helpful bot. If you cannot answer based on the context provided, respond with a generic answer. Answer the question as truthfully as possible using the context below:
+        {context}
+
+        Question: {question}"""
+
+    prompt = ChatPromptTemplate.from_template(template)
+    return prompt | llm | StrOutputParser()
+
+
+def build_pure_chain(llm):
+    """Return the pure LLM chain without RAG"""
+    template_without_rag = """You are a helpful bot. Answer the question as truthfully as possible.
+
+        Question: {question}"""
+
+    prompt_without_rag = ChatPromptTemplate.from_template(template_without_rag)
+    return (
+        {"question": RunnablePassthrough()}
+        | prompt_without_rag
+        | llm
+        | StrOutputParser()
+    )
+
+
+def document_ttl():
+    """Return the seconds uploaded documents live without being uploaded again, DOCUMENT_TTL=0 keeps them"""
+    return int(os.getenv("DOCUMENT_TTL", "3600"))
+
+
+def documents_changed(vector_store):
+    """Bump the store's generation after documents were added or removed, dropping the cached searches and RAG answers"""
+    bump_generation(vector_store)
+    # This process sees its own change on the next lookup, other processes within their check interval
+    get_generation_counter(vector_store).recheck()
+
+
+def ingest_upload(file_name, data, vector_store, progress=None, tenant=SHARED_TENANT):
+    """Chunk the uploaded PDF bytes into the vector store and return the ingest stats
+
+    The upload replaces the tenant's previous version of the document with
+    the same file name, and expires after DOCUMENT_TTL seconds.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_file_path = os.path.join(temp_dir, os.path.basename(file_name))
+        with open(temp_file_path, "wb") as f:
+            f.write(data)
+
+        with tracing.trace("ingest", file=file_name) as ingest_trace:
+            stats = ingest_pdf(
+                temp_file_path, vector_store, progress=progress, source=file_name, ttl=document_ttl(), tenant=tenant
+            )
+            ingest_trace.count("pages", stats["pages"])
+            ingest_trace.count("chunks", stats["chunks"])
+            ingest_trace.count("skipped", stats["skipped"])
+            ingest_trace.count("removed", stats["removed"])
+
+    if stats["chunks"] or stats["removed"]:
+        documents_changed(vector_store)
+    return stats
+
+
+def remove_upload(source, vector_store, tenant=SHARED_TENANT):
+    """Delete the tenant's named document from the vector store and return how many chunks were deleted"""
+    with tracing.trace("delete", file=source) as delete_trace:
+        deleted = delete_document(vector_store, source, tenant)
+        delete_trace.count("removed", deleted)
+
+    if deleted:
+        documents_changed(vector_store)
+    return deleted
+
+
+@lru_cache(maxsize=None)
+def get_components():
+    """Build the clients, caches and chains from the environment, once per process
+
+    Returns a dict with the `embedding`, `vector_store`, `search_client`
+    (None unless RETRIEVER_MODE=async), `answer_cache`, `retriever` (of
+    every tenant), `assemble`, `chain` (RAG) and `chain_without_rag`.
+    """
+    missing = [name for name in required_environment_variables() if name not in os.environ]
+    if missing:
+        raise RuntimeError(f"Environment variables not set: {', '.join(missing)}")
+
+    embedding = make_embedding(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite"))
+    cluster = None
+    search_client = None
+    if not use_local_vector_store():
+        cluster = connect_to_couchbase(os.getenv("CB_HOSTNAME"), os.getenv("CB_USERNAME"), os.getenv("CB_PASSWORD"))
+        if os.getenv("RETRIEVER_MODE") == "async":
+            search_client = make_async_search_client(
+                os.getenv("CB_HOSTNAME"),
+                os.getenv("CB_USERNAME"),
+                os.getenv("CB_PASSWORD"),
+                os.getenv("CB_BUCKET"),
+                os.getenv("CB_SCOPE"),
+                os.getenv("CB_SEARCHINDEX"),
+                int(os.getenv("SEARCH_MAX_CONCURRENCY", "16")),
+                float(os.getenv("SEARCH_TIMEOUT", "5")),
+                int(os.getenv("SEARCH_RETRIES", "2")),
+            )
+    vector_store = make_vector_store(
+        cluster,
+        os.getenv("CB_BUCKET"),
+        os.getenv("CB_SCOPE"),
+        os.getenv("CB_COLLECTION"),
+        embedding,
+        os.getenv("CB_SEARCHINDEX"),
+    )
+    return {
+        "embedding": embedding,
+        "vector_store": vector_store,
+        "search_client": search_client,
+        "answer_cache": make_answer_cache(embedding, vector_store),
+        "retriever": make_retriever(vector_store, embedding, search_client),
+        "assemble": make_assemble(embedding),
+        "chain": build_rag_chain(make_llm(temperature=0, streaming=True)),
+        "chain_without_rag": build_pure_chain(make_llm()),
+    }
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+_DONE = object()
+
+
+def format_docs(docs):
+    """Join the page content of the retrieved documents into one context string"""
+    return "\n".join([doc.page_content for doc in docs])
+
+
+def retrieve(retriever, question, timings):
+    """Run the retriever once and record how long it took"""
+    start = time.perf_counter()
+    with tracing.span("retrieval"):
+        docs = retriever.invoke(question)
+    timings["retrieval"] = time.perf_counter() - start
+    return docs
+
+
+def stream_answer(chain, inputs, timings, prefix=""):
+    """Stream the chain output, recording time-to-first-token and total generation time"""
+    start = time.perf_counter()
+    first_token = None
+    with tracing.span(prefix + "generation") as attrs:
+        for chunk in chain.stream(inputs):
+            if first_token is None:
+                first_token = time.perf_counter()
+                timings[prefix + "first_token"] = first_token - start
+                attrs["first_token_ms"] = timings[prefix + "first_token"] * 1000
+            tracing.count(prefix + "completion_chunks")
+            yield chunk
+    timings[prefix + "generation"] = time.perf_counter() - start
+
+
+def stream_rag_answer(retriever, chain, question, timings, sent, assemble=None):
+    """Retrieve the context once, record what is sent to the LLM in `sent` and stream the answer
+
+    `assemble(question, docs, timings)` turns the retrieved documents into
+    the context string, by default they are simply joined.
+    """
+    docs = retrieve(retriever, question, timings)
+    if assemble is None:
+        context = format_docs(docs)
+    else:
+        start = time.perf_counter()
+        with tracing.span("assembly"):
+            context = assemble(question, docs, timings)
+        timings["assembly"] = time.perf_counter() - start
+    sent.update({"context": context, "question": question})
+    yield from stream_answer(chain, dict(sent), timings, prefix="rag_")
+
+
+def stream_sequentially(streams):
+    """Run the named stream factories one after another, yielding (name, chunk) pairs"""
+    for name, factory in streams.items():
+        for chunk in factory():
+            yield name, chunk
+
+
+def stream_concurrently(streams):
+    """Run the named stream factories in a thread pool, yielding (name, chunk) pairs as they arrive
+
+    The chunks are handed back to the calling thread so the caller can keep
+    all of its rendering (e.g. Streamlit placeholders) on its own thread.
+    If the caller stops iterating (a rerun or a disconnected client) or a
+    stream raises, the other streams are closed at their next chunk instead
+    of generating their whole answer first.
+    """
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def worker(name, factory):
+        stream = factory()
+        try:
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                results.put((name, chunk, None))
+        except Exception as e:
+            results.put((name, None, e))
+        finally:
+            # Closing the generator closes the LLM's streamed response
+            stream.close()
+            results.put((name, _DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=max(len(streams), 1))
+    try:
+        for name, factory in streams.items():
+            tracing.submit(executor, worker, name, factory)
+
+        running = len(streams)
+        while running:
+            name, chunk, error = results.get()
+            if error is not None:
+                raise error
+            if chunk is _DONE:
+                running -= 1
+                continue
+            yield name, chunk
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_timings(timings):
+    """Render the recorded stage timings (seconds) and counts (ints) as a short human readable line"""
+    return " | ".join(
+        f"{stage}: {value}" if isinstance(value, int) else f"{stage}: {value * 1000:.0f} ms"
+        for stage, value in timings.items()
+    )
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import tracing
+from answer_cache import normalize_question
+
+# Rough per-object overhead of the Python containers, for the memory cap
+ENTRY_OVERHEAD = 200
+CHUNK_OVERHEAD = 300
+
+
+def quantize(vector):
+    """Return the L2 normalized vector rounded to int8, so float noise doesn't change the key"""
+    vector = np.asarray(vector, dtype=np.float32)
+    vector = vector / (np.linalg.norm(vector) or 1.0)
+    return np.round(vector * 127).astype(np.int8).tobytes()
+
+
+def retrieval_key(k, tenants, vector=None, text=None):
+    """Return the cache key of a search for the quantized `vector` (or the `text`), `k` and tenant filter"""
+    digest = hashlib.sha256(json.dumps([k, sorted(tenants) if tenants is not None else None, text]).encode("utf-8"))
+    if vector is not None:
+        digest.update(quantize(vector))
+    return digest.digest()
+
+
+class RetrievalCache:
+    """LRU cache of retrieved chunks, invalidated when the vector store's generation changes
+
+    Each entry holds the keys of the chunks a search returned, and every
+    chunk's text and metadata is kept once however many entries share it.
+    Entries are dropped once the store's generation (returned by
+    `generation`, e.g. a GenerationCounter) has moved on from the one they
+    were retrieved at, after `ttl` seconds, so expired documents drop out,
+    and least recently used first past `max_bytes`.
+    """
+
+    def __init__(self, generation, max_bytes=64 * 1024 * 1024, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._generation_source = generation
+        self._generation = None
+        self._entries = OrderedDict()
+        self._chunks = {}
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """Return the store's generation, dropping every entry once it has changed"""
+        generation = self._generation_source()
+        with self._lock:
+            if generation != self._generation:
+                self._clear()
+                self._generation = generation
+        return generation
+
+    def _chunk_key(self, doc):
+        return doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= ENTRY_OVERHEAD + 16 * len(entry["chunks"])
+        for chunk_key in entry["chunks"]:
+            chunk = self._chunks[chunk_key]
+            chunk["refs"] -= 1
+            if not chunk["refs"]:
+                del self._chunks[chunk_key]
+                self.bytes -= chunk["size"]
+
+    def _clear(self):
+        self._entries.clear()
+        self._chunks.clear()
+        self.bytes = 0
+
+    def get(self, key):
+        """Return the cached documents of the search key, or None"""
+        generation = self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry["generation"] != generation or time.time() - entry["created"] > self.ttl):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                tracing.count("retrieval_cache_misses")
+                return None
+            self.hits += 1
+            tracing.count("retrieval_cache_hits")
+            self._entries.move_to_end(key)
+            return [
+                Document(id=self._chunks[chunk_key]["id"], page_content=self._chunks[chunk_key]["text"], metadata=dict(self._chunks[chunk_key]["metadata"]))
+                for chunk_key in entry["chunks"]
+            ]
+
+    def put(self, key, docs, generation):
+        """Cache the documents a search returned at `generation`, unless the store has moved on since"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            chunk_keys = []
+            for doc in docs:
+                chunk_key = self._chunk_key(doc)
+                chunk = self._chunks.get(chunk_key)
+                if chunk is None:
+                    size = CHUNK_OVERHEAD + len(doc.page_content.encode("utf-8")) + len(json.dumps(doc.metadata, default=str))
+                    chunk = self._chunks[chunk_key] = {
+                        "id": doc.id,
+                        "text": doc.page_content,
+                        "metadata": dict(doc.metadata),
+                        "size": size,
+                        "refs": 0,
+                    }
+                    self.bytes += size
+                chunk["refs"] += 1
+                chunk_keys.append(chunk_key)
+            self._entries[key] = {"chunks": tuple(chunk_keys), "generation": generation, "created": time.time()}
+            self.bytes += ENTRY_OVERHEAD + 16 * len(chunk_keys)
+            while self.bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self):
+        """Return the hit and miss counters and the memory used"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+        }
+
+
+class CachedRetriever(BaseRetriever):
+    """Retriever answering repeated searches from a RetrievalCache before calling `retriever`
+
+    Searches are keyed on the quantized query embedding, `k` and `tenants`,
+    the query embedding comes from the (cached) `embedding`, so the wrapped
+    retriever embedding the query again on a miss costs no API call. With
+    `key_on_text` the normalized question is the key instead, for
+    retrievers that also match the text and may skip the embedding.
+    """
+
+    retriever: Any
+    embedding: Any
+    cache: Any
+    k: int = 4
+    tenants: Optional[List[str]] = None
+    key_on_text: bool = False
+
+    def _key(self, query, vector):
+        if self.key_on_text:
+            return retrieval_key(self.k, self.tenants, text=normalize_question(query))
+        return retrieval_key(self.k, self.tenants, vector=vector)
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        # Read before searching, so a bump during the search keeps the result out of the cache
+        generation = self.cache.generation()
+        key = self._key(query, None if self.key_on_text else self.embedding.embed_query(query))
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+            self.cache.put(key, docs, generation)
+        return docs
+
+    async def _aget_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        generation = self.cache.generation()
+        key = self._key(query, None if self.key_on_text else await self.embedding.aembed_query(query))
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+            self.cache.put(key, docs, generation)
+        return docs
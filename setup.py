@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
+import json
 import os
 import sys
 import requests
 import time
-from requests.auth import HTTPBasicAuth
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 from couchbase.cluster import Cluster
@@ -17,50 +17,48 @@ from couchbase.management.buckets import CreateBucketSettings
 from couchbase.management.collections import CollectionSpec
 from couchbase.management.buckets import BucketType, ConflictResolutionType
 
-def process_template_to_json(search_index_name, bucket_name, scope_name, collection_name):
+from documents import bump_generation, delete_document, list_documents
+from index_profiles import DEFAULT_DIMS, index_settings, put_index_definition, render_index_definition, settings_from_env
+
+def process_template_to_json(search_index_name, bucket_name, scope_name, collection_name, settings=None):
     # Define the path of the input template and the output JSON file
     template_file_path = 'search_indexdef.tmpl'
     output_file_path = 'search_indexdef.json'
-    
+
+    # The profile picks the dims, partitions and recall/latency tuning of the vector field
+    if settings is None:
+        settings = index_settings()
+
     try:
         # Open the template file for reading
         with open(template_file_path, 'r') as template_file:
             # Read the content of the template file
-            content = template_file.read()
-            
-            # Substitute the placeholders with the provided variable values
-            content = content.replace('_CB_SEARCHINDEX_', search_index_name)
-            content = content.replace('_CB_BUCKET_', bucket_name)
-            content = content.replace('_CB_SCOPE_', scope_name)
-            content = content.replace('_CB_COLLECTION_', collection_name)
-            
+            template = template_file.read()
+
+        # Substitute the placeholders and apply the profile
+        definition = render_index_definition(template, search_index_name, bucket_name, scope_name, collection_name, settings)
+
         # Open the output JSON file for writing
         with open(output_file_path, 'w') as output_file:
             # Write the processed content to the output file
-            output_file.write(content)
-            
+            json.dump(definition, output_file, indent=2)
+
         print("Template processing completed successfully, made index definition file 'search_indexdef.json'.")
-        
+        print(f"Index profile '{settings['profile']}': {settings['dims']} dims, {settings['partitions']} partition(s), optimized for {settings['optimized_for']}.")
+        if settings['dims'] != int(os.getenv("EMBEDDING_DIMS", DEFAULT_DIMS)):
+            print(f"Set EMBEDDING_DIMS={settings['dims']} (with a text-embedding-3 EMBEDDING_MODEL) so the app's embeddings match the index.")
+
     except IOError as e:
         print(f"An error occurred while processing the template: {e}")
 
 
 def update_search_index(cb_username, cb_password, cb_hostname, cb_bucket, cb_scope, cb_searchindex):
-    # Construct the URL for the PUT request
-    url = f"https://{cb_hostname}:18094/api/bucket/{cb_bucket}/scope/{cb_scope}/index/{cb_searchindex}"
-    
     # Load the JSON data from file
     with open("./search_indexdef.json", "r") as file:
         json_data = file.read()
     
     # Make the PUT request
-    response = requests.put(
-        url,
-        headers={"Content-Type": "application/json"},
-        auth=HTTPBasicAuth(cb_username, cb_password),
-        data=json_data,
-        verify=False  # Use this to skip SSL verification, equivalent to curl's -k option
-    )
+    response = put_index_definition(cb_username, cb_password, cb_hostname, cb_bucket, cb_scope, cb_searchindex, json_data)
     
     # Check the response status
     if response.ok:
@@ -120,6 +118,12 @@ scope_name = os.getenv("CB_SCOPE")
 collection_name = os.getenv("CB_COLLECTION")
 search_index_name = os.getenv("CB_SEARCHINDEX")
 
+try:
+    index_profile_settings = settings_from_env()
+except ValueError as e:
+    print(e)
+    sys.exit(1)
+
 bucket_manager = cluster.buckets()
 
 bucket = get_bucket(cluster, bucket_name)
@@ -174,10 +178,31 @@ else:
     print(f"Collection '{collection_name}' is present.")
     have_collection = True
 
-process_template_to_json(search_index_name, bucket_name, scope_name, collection_name)
+process_template_to_json(search_index_name, bucket_name, scope_name, collection_name, index_profile_settings)
 
 
 if have_collection:
+    # Delete single PDFs, their chunks are found through their manifest
+    collection = bucket.scope(scope_name).collection(collection_name)
+    loaded = list_documents(collection)
+    if loaded:
+        print("Loaded PDFs:")
+        for number, document in enumerate(loaded, 1):
+            print(
+                f"  {number}. {document['source']} of tenant '{document['tenant']}' "
+                f"({document['pages']} pages, {document['chunks']} documents)"
+            )
+        user_input = input("Enter the numbers of the PDFs to delete, separated by spaces (or press enter to skip): ")
+        for number in user_input.replace(",", " ").split():
+            if not number.isdigit() or not 1 <= int(number) <= len(loaded):
+                print(f"Skipping '{number}', not a listed PDF.")
+                continue
+            document = loaded[int(number) - 1]
+            deleted = delete_document(collection, document["source"], document["tenant"])
+            if deleted:
+                bump_generation(collection)
+            print(f"PDF '{document['source']}' deleted, {deleted} documents removed.")
+
     user_input = input("Do you want to clear out your data? (yes/y): ").upper()
     if user_input == "YES" or user_input == "Y":
         collections_manager.drop_collection(scope_name, collection_name)
@@ -0,0 +1,58 @@
+import os
+import re
+import uuid
+
+# Documents every tenant can retrieve, e.g. the ones loaded by ingest_pdfs.py
+SHARED_TENANT = "shared"
+# The keyword field of the search index the tenant is indexed in
+TENANT_FIELD = "metadata.tenant"
+
+
+def isolate_tenants():
+    """Return True unless TENANT_SCOPE=shared, which lets everyone search every PDF"""
+    return os.getenv("TENANT_SCOPE", "session") != "shared"
+
+
+def resolve_tenant(tenant=None):
+    """Return the tenant to tag uploads with, `tenant` if given and tenants are isolated, else the shared one"""
+    return tenant if tenant and isolate_tenants() else SHARED_TENANT
+
+
+def new_session_tenant():
+    """Return the tenant of a new browser session, which only sees its own and the shared PDFs"""
+    return resolve_tenant(uuid.uuid4().hex)
+
+
+def session_tenant(tenant=None):
+    """Return `tenant` if it is a session's tenant, e.g. kept in the page URL, else a new session's
+
+    Only the random tenants of sessions are accepted, so a URL can't name
+    the shared tenant or an API tenant.
+    """
+    if tenant and re.fullmatch(r"[0-9a-f]{32}", tenant):
+        return resolve_tenant(tenant)
+    return new_session_tenant()
+
+
+def visible_tenants(tenant):
+    """Return the tenants whose documents `tenant` may retrieve, or None for all of them when TENANT_SCOPE=shared"""
+    if not isolate_tenants():
+        return None
+    return list(dict.fromkeys([resolve_tenant(tenant), SHARED_TENANT]))
+
+
+def answer_mode(mode, tenant):
+    """Return the answer cache mode of the tenant, RAG answers are only shared by sessions that see the same PDFs"""
+    if mode != "rag" or not isolate_tenants() or resolve_tenant(tenant) == SHARED_TENANT:
+        return mode
+    return f"{mode}:{tenant}"
+
+
+def tenant_filter(tenants):
+    """Return the search query matching the documents of `tenants`, for prefiltering a kNN query, or None"""
+    if not tenants:
+        return None
+    from couchbase import search
+
+    queries = [search.TermQuery(tenant, field=TENANT_FIELD) for tenant in tenants]
+    return queries[0] if len(queries) == 1 else search.DisjunctionQuery(*queries)
@@ -0,0 +1,49 @@
+from answer_cache import AnswerCache
+from fakes import HashingEmbeddings
+
+QUESTION = "how do I configure the replica count of a bucket so that every document in the cluster survives the loss of one node"
+
+
+def make_cache(generation=None, **kwargs):
+    return AnswerCache(HashingEmbeddings(dims=1536), generation, **kwargs)
+
+
+def test_exact_and_reworded_question_hit():
+    cache = make_cache()
+    cache.put("pure", QUESTION, "Set the replicas to 1.")
+    assert cache.get("pure", "  How do I configure the REPLICA count of a bucket so that every document in the cluster survives the loss of one node?")
+    # The same words in another order embed to the same vector
+    assert cache.get("pure", "so that every document in the cluster survives the loss of one node how do I configure the replica count of a bucket")
+
+
+def test_near_miss_paraphrase_misses():
+    cache = make_cache()
+    cache.put("pure", QUESTION, "Set the replicas to 1.")
+    # One word changes the question, but the embeddings are about 0.97 similar
+    assert cache.get("pure", QUESTION.replace("configure", "remove")) is None
+
+
+def test_near_miss_paraphrase_hits_with_a_loose_threshold():
+    cache = make_cache(threshold=0.95)
+    cache.put("pure", QUESTION, "Set the replicas to 1.")
+    assert cache.get("pure", QUESTION.replace("configure", "remove"))
+
+
+def test_rag_answers_expire_with_the_generation():
+    generation = [0]
+    cache = make_cache(lambda: generation[0])
+    cache.put("pure", QUESTION, "Set the replicas to 1.")
+    cache.put("rag", QUESTION, "Set the replicas to 1, see page 3.", {"context": "...", "question": QUESTION}, 0)
+    assert cache.get("rag", QUESTION)
+
+    # Documents were added or removed, e.g. by an upload in another process
+    generation[0] = 1
+    assert cache.get("rag", QUESTION) is None
+    assert cache.get("pure", QUESTION)
+
+
+def test_rag_answer_generated_across_an_upload_is_not_served():
+    generation = [1]
+    cache = make_cache(lambda: generation[0])
+    cache.put("rag", QUESTION, "An answer from the old documents.", {"context": "..."}, 0)
+    assert cache.get("rag", QUESTION) is None
@@ -0,0 +1,25 @@
+import couchbase.logic.collection as collection_logic
+from couchbase.collection import Collection
+
+from documents import GENERATION_ID, bump_generation
+
+
+class StubScope:
+    connection = None
+    bucket_name = "bucket"
+    name = "scope"
+    default_transcoder = None
+
+
+class StubCounterResult:
+    raw_result = {"key": GENERATION_ID, "cas": 1, "content": 7}
+
+
+def test_bump_generation_passes_the_sdk_argument_validation(monkeypatch):
+    # A real Collection validates the IncrementOptions, only the call into the C++ core is stubbed
+    calls = []
+    monkeypatch.setattr(collection_logic, "binary_operation", lambda **kwargs: calls.append(kwargs) or StubCounterResult())
+
+    assert bump_generation(Collection(StubScope(), "collection")) == 7
+    assert calls[0]["key"] == GENERATION_ID
+    assert calls[0]["op_args"] == {"initial": 1, "delta": 1}
@@ -0,0 +1,183 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+_current = contextvars.ContextVar("trace", default=None)
+_log_lock = threading.Lock()
+
+# The most recent traces of this process, for the sidebar panel and the metrics endpoint
+recent_traces = deque(maxlen=500)
+
+
+class Trace:
+    """Spans and counters recorded while handling one request (a question or an upload)"""
+
+    def __init__(self, name, **attrs):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Record how long the block took, relative to the start of the trace"""
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append(
+                    {
+                        "name": name,
+                        "start_ms": (start - self._start) * 1000,
+                        "ms": (end - start) * 1000,
+                        **attrs,
+                    }
+                )
+
+    @contextmanager
+    def timed(self, name):
+        """Add how long the block took to the `<name>_ms` counter, for stages run many times"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name + "_ms", (time.perf_counter() - start) * 1000)
+
+    def count(self, name, value=1):
+        """Add `value` to the named counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        """Set the duration, then keep the trace and append it to TRACE_LOG if set"""
+        self.duration = time.perf_counter() - self._start
+        recent_traces.append(self)
+        log_path = os.getenv("TRACE_LOG")
+        if log_path:
+            with _log_lock, open(log_path, "a") as log_file:
+                log_file.write(json.dumps(self.to_dict()) + "\n")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started": self.started,
+            "ms": self.duration * 1000 if self.duration is not None else None,
+            **self.attrs,
+            "spans": self.spans,
+            "counters": self.counters,
+        }
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Make a new trace current for the block, then keep it and append it to TRACE_LOG if set"""
+    current = Trace(name, **attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+def current_trace():
+    """Return the trace of the running request, or None"""
+    return _current.get()
+
+
+def span(name, **attrs):
+    """Record a span on the current trace, a no-op outside of one"""
+    current = _current.get()
+    return current.span(name, **attrs) if current else nullcontext(attrs)
+
+
+def timed(name):
+    """Accumulate time into a counter on the current trace, a no-op outside of one"""
+    current = _current.get()
+    return current.timed(name) if current else nullcontext()
+
+
+def count(name, value=1):
+    """Add to a counter on the current trace, a no-op outside of one"""
+    current = _current.get()
+    if current:
+        current.count(name, value)
+
+
+def submit(executor, fn, *args):
+    """Submit to an executor with the caller's trace context, so worker threads record into it"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def summarize(traces=None):
+    """Return p50/p95/p99 in ms of every span name, and counter totals, over the traces"""
+    traces = list(recent_traces if traces is None else traces)
+    durations = {}
+    counters = {}
+    for t in traces:
+        if t.duration is not None:
+            durations.setdefault(t.name, []).append(t.duration * 1000)
+        for s in t.spans:
+            durations.setdefault(s["name"], []).append(s["ms"])
+        for name, value in t.counters.items():
+            counters[name] = counters.get(name, 0) + value
+    return {
+        "traces": len(traces),
+        "spans": {
+            name: {
+                "count": len(values),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+            }
+            for name, values in durations.items()
+        },
+        "counters": counters,
+    }
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = summarize()
+        elif self.path == "/traces":
+            body = [t.to_dict() for t in list(recent_traces)]
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics (summary) and /traces (recent traces) as JSON from a background thread
+
+    The traces include uploaded file names and there is no authentication,
+    so only this host can connect unless another `host` is given.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server